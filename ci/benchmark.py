@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import collections
+import importlib.metadata
+import inspect
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+SCRIPT_DIR = Path(__file__).parent
+sys.path.insert(1, SCRIPT_DIR.parent.as_posix())
+
+import papertrail  # noqa: E402
+
+SAMPLE_TEXT = (
+    "The quick brown fox jumps over the lazy dog. Invoice number 4711 dated 2023-10-01 for the amount of 1234.56 EUR. "
+    "Please remit payment within thirty days to the account listed below. Thank you for your business."
+).split()
+
+
+def generate_image_corpus(corpus_dir: Path, count: int, lines: int = 20) -> list[Path]:
+    from PIL import Image, ImageDraw, ImageFont  # noqa: PLC0415
+
+    corpus_dir.mkdir(parents=True, exist_ok=True)
+    try:
+        font = ImageFont.truetype("DejaVuSans.ttf", 28)
+    except OSError:
+        font = ImageFont.load_default()
+    files: list[Path] = []
+    for index in range(count):
+        fpath = corpus_dir / f"page{index:05d}.png"
+        files.append(fpath)
+        if fpath.exists():
+            continue
+        image = Image.new("RGB", (1654, 2339), "white")
+        draw = ImageDraw.Draw(image)
+        for line in range(lines):
+            draw.text((100, 100 + line * 100), " ".join(_image_corpus_line(index, line)), fill="black", font=font)
+        image.save(fpath)
+    return files
+
+
+def _image_corpus_line(index: int, line: int) -> list[str]:
+    return [SAMPLE_TEXT[(index + line + word) % len(SAMPLE_TEXT)] for word in range(10)]
+
+
+def generate_text_pdf(fpath: Path, pages: int, lines: int = 60):
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>"]
+    kids = " ".join(f"{3 + 2 * page} 0 R" for page in range(pages))
+    objects.append(f"<< /Type /Pages /Kids [{kids}] /Count {pages} >>")
+    font_id = 3 + 2 * pages
+    for page in range(pages):
+        resources = f"<< /Font << /F1 {font_id} 0 R >> >>"
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources {resources} /Contents {4 + 2 * page} 0 R >>")
+        text_lines = [" ".join(SAMPLE_TEXT[(page + line + word) % len(SAMPLE_TEXT)] for word in range(12)) for line in range(lines)]
+        stream = "BT /F1 8 Tf 11 TL 40 760 Td " + " ".join(f"({text}) '" for text in text_lines) + " ET"
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+    objects.append("<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    data = "%PDF-1.4\n"
+    offsets = []
+    for number, obj in enumerate(objects, 1):
+        offsets.append(len(data))
+        data += f"{number} 0 obj\n{obj}\nendobj\n"
+    xref = len(data)
+    data += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n" + "".join(f"{offset:010d} 00000 n \n" for offset in offsets)
+    data += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n"
+    fpath.write_text(data, encoding="latin-1")
+
+
+def _jobs(files: list[Path], out_dir: Path) -> list[tuple[str, str, None]]:
+    jobs = []
+    for fpath in files:
+        metadata_dir = out_dir / fpath.stem
+        metadata_dir.mkdir(parents=True, exist_ok=True)
+        jobs.append((fpath.as_posix(), metadata_dir.as_posix(), None))
+    return jobs
+
+
+def _chunks(jobs: list[tuple[str, str, None]], size: int) -> list[list[tuple[str, str, None]]]:
+    return [jobs[index : index + size] for index in range(0, len(jobs), size)]
+
+
+def _run_serial(files: list[Path], out_dir: Path, threads: int, page_batch: int, per_file: bool) -> float:
+    papertrail.set_torch_threads(threads)
+    options = papertrail.ExtractionOptions(page_batch=page_batch)
+    model = papertrail.create_ocr_predictor(options)
+    jobs = _jobs(files, out_dir)
+    start = time.perf_counter()
+    for chunk in _chunks(jobs, 1 if per_file else page_batch):
+        papertrail.extract_texts(model, chunk, options)
+    return time.perf_counter() - start
+
+
+def _run_pool(files: list[Path], out_dir: Path, workers: int, threads: int, page_batch: int) -> float:
+    # The supervised workers of the service with its default time and memory limits, including their startup
+    jobs = _jobs(files, out_dir)
+    start = time.perf_counter()
+    pool = papertrail.OCRSupervisor(workers, (threads, papertrail.ExtractionOptions(page_batch=page_batch), 0), 300, 4096 << 20)
+    try:
+        for future in [pool.submit(chunk) for chunk in _chunks(jobs, page_batch)]:
+            future.result()
+    finally:
+        pool.shutdown()
+    return time.perf_counter() - start
+
+
+def _report(count: int, results: list[tuple[str, float]]):
+    baseline = results[0][1]
+    sys.stdout.write(f"{'mode':<48}{'seconds':>10}{'files/s':>10}{'speedup':>10}\n")
+    for name, elapsed in results:
+        sys.stdout.write(f"{name:<48}{elapsed:>10.2f}{count / elapsed:>10.2f}{baseline / elapsed:>10.2f}\n")
+
+
+def bench_ocr_pool(corpus_dir: Path, files: int, workers: list[int], threads: int, page_batch: int):
+    corpus = generate_image_corpus(corpus_dir, files)
+    results: list[tuple[str, float]] = []
+    with tempfile.TemporaryDirectory() as tmp:
+        results.append(("serial per file", _run_serial(corpus, Path(tmp) / "serial", 0, page_batch, per_file=True)))
+        results.append((f"serial page_batch={page_batch}", _run_serial(corpus, Path(tmp) / "batched", 0, page_batch, per_file=False)))
+        for count in workers:
+            out_dir = Path(tmp) / f"pool{count}"
+            elapsed = _run_pool(corpus, out_dir, count, threads, page_batch)
+            results.append((f"pool workers={count} threads={threads}", elapsed))
+            shutil.rmtree(out_dir, ignore_errors=True)
+    _report(len(corpus), results)
+
+
+# Options of the inference modes, combined with "+" on the command line
+INFERENCE_MODES: dict[str, dict[str, object]] = {
+    "default": {},
+    "mobilenet": {"det_arch": "db_mobilenet_v3_large", "reco_arch": "crnn_mobilenet_v3_small"},
+    "quantize": {"quantize": True},
+    "channels-last": {"channels_last": True},
+    "compile": {"compile_model": True},
+    "pixels-2m": {"max_page_pixels": 2_000_000},
+    "preprocess": {"deskew": True, "skip_blank": True},
+}
+
+
+def _word_accuracy(expected: list[str], extracted: list[str]) -> float:
+    # Share of the expected words that were recognized, regardless of their order
+    return sum((collections.Counter(expected) & collections.Counter(extracted)).values()) / max(len(expected), 1)
+
+
+def _package_version(package: str) -> str:
+    try:
+        return importlib.metadata.version(package)
+    except importlib.metadata.PackageNotFoundError:
+        return "unknown"
+
+
+def _inference_setup(threads: int) -> str:
+    # The default mode runs the architectures the installed doctr picks, the report names them
+    import doctr.models  # noqa: PLC0415
+
+    defaults = {name: parameter.default for name, parameter in inspect.signature(doctr.models.ocr_predictor).parameters.items()}
+    return (
+        f"doctr {_package_version('python-doctr')}, torch {_package_version('torch')}, "
+        f"default architectures {defaults.get('det_arch')} + {defaults.get('reco_arch')}, {threads or 'default'} torch threads\n"
+    )
+
+
+def bench_inference(corpus_dir: Path, files: int, modes: list[str], threads: int, page_batch: int):
+    corpus = generate_image_corpus(corpus_dir, files)
+    expected = [[word for line in range(20) for word in _image_corpus_line(index, line)] for index in range(len(corpus))]
+    papertrail.set_torch_threads(threads)
+    results: list[tuple[str, float, float]] = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in modes:
+            kwargs = {key: value for name in mode.split("+") for key, value in INFERENCE_MODES[name].items()}
+            options = papertrail.ExtractionOptions(page_batch=page_batch, **kwargs)
+            model = papertrail.create_ocr_predictor(options)
+            # The first batch pays for lazy initialization and compilation, it is not timed
+            papertrail.extract_texts(model, _jobs(corpus[:1], Path(tmp) / "warm-up"), options)
+            jobs = _jobs(corpus, Path(tmp) / mode)
+            start = time.perf_counter()
+            for chunk in _chunks(jobs, page_batch):
+                papertrail.extract_texts(model, chunk, options)
+            elapsed = time.perf_counter() - start
+            accuracy = [
+                _word_accuracy(words, papertrail.build_text_store(Path(metadata_dir))[0].split())
+                for words, (_, metadata_dir, _) in zip(expected, jobs, strict=True)
+            ]
+            results.append((mode, elapsed, sum(accuracy) / len(accuracy)))
+    baseline = results[0][1]
+    sys.stdout.write(_inference_setup(threads))
+    sys.stdout.write(f"{'mode':<48}{'seconds':>10}{'pages/s':>10}{'speedup':>10}{'words':>10}\n")
+    for name, elapsed, accuracy in results:
+        sys.stdout.write(f"{name:<48}{elapsed:>10.2f}{len(corpus) / elapsed:>10.2f}{baseline / elapsed:>10.2f}{accuracy:>10.1%}\n")
+
+
+def _legacy_pdf_text_page(page) -> dict:
+    textpage = page.get_textpage()
+    lines: list = []
+    for rect_index in range(textpage.count_rects()):
+        rect = textpage.get_rect(rect_index)
+        text = textpage.get_text_bounded(*rect)
+        if len(text) == 0:
+            continue
+        lines.append({"words": [{"value": text, "geometry": rect}]})
+    return {"blocks": [{"lines": lines}]}
+
+
+def _time_pdf_text(pdfs: list[Path], extract) -> float:
+    start = time.perf_counter()
+    for fpath in pdfs:
+        pdf = papertrail.pypdfium2.PdfDocument(fpath.as_posix())
+        for index in range(len(pdf)):
+            extract(pdf[index])
+        pdf.close()
+    return time.perf_counter() - start
+
+
+def bench_pdf_text(corpus_dir: Path, files: int, pages: int, lines: int):
+    corpus_dir.mkdir(parents=True, exist_ok=True)
+    pdfs = [corpus_dir / f"text{index:03d}_{pages}x{lines}.pdf" for index in range(files)]
+    for fpath in pdfs:
+        if not fpath.exists():
+            generate_text_pdf(fpath, pages, lines)
+    results = [
+        ("get_text_bounded per rect", _time_pdf_text(pdfs, _legacy_pdf_text_page)),
+        ("get_text_range", _time_pdf_text(pdfs, lambda page: papertrail.pdf_text_page(page, 0))),
+        ("get_text_range + word boxes", _time_pdf_text(pdfs, lambda page: papertrail.pdf_text_page(page, 0, geometry=True))),
+    ]
+    baseline = results[0][1]
+    sys.stdout.write(f"{'mode':<48}{'seconds':>10}{'pages/s':>10}{'speedup':>10}\n")
+    for name, elapsed in results:
+        sys.stdout.write(f"{name:<48}{elapsed:>10.2f}{files * pages / elapsed:>10.1f}{baseline / elapsed:>10.2f}\n")
+
+
+def _percentile(latencies: list[float], fraction: float) -> float:
+    ordered = sorted(latencies)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+async def _load_test(search, queries: list[dict[str, object]], concurrency: int, requests: int) -> tuple[float, list[float]]:
+    latencies: list[float] = []
+    remaining = iter(range(requests))
+
+    async def client():
+        for index in remaining:
+            start = time.perf_counter()
+            await search(queries[index % len(queries)])
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    return time.perf_counter() - start, latencies
+
+
+async def _bench_search(port: int, concurrency: list[int], requests: int) -> list[tuple[str, float, list[float]]]:
+    sync_client = papertrail.typesense.Client(
+        {"api_key": papertrail.TYPESENSE_API_KEY, "nodes": [{"host": "localhost", "port": f"{port}", "protocol": "http"}]}
+    )
+    loop = asyncio.get_running_loop()
+
+    async def executor_search(query: dict[str, object]):
+        return await loop.run_in_executor(None, lambda: sync_client.collections["documents"].documents.search(query))
+
+    async_client = papertrail.TypesenseSearchClient(port, papertrail.TYPESENSE_API_KEY, max_concurrency=max(concurrency))
+    # Prefixes of the sample words, like the queries of search-as-you-type
+    queries = [
+        {"q": word[:length], "query_by": "filename,contents", "exclude_fields": "contents", "per_page": papertrail.SEARCH_PER_PAGE}
+        for word in SAMPLE_TEXT
+        for length in range(2, len(word) + 1)
+    ]
+    results = []
+    for count in concurrency:
+        for name, search in (("executor", executor_search), ("async", async_client.search)):
+            elapsed, latencies = await _load_test(search, queries, count, requests)
+            results.append((f"{name} concurrency={count}", elapsed, latencies))
+    await async_client.close()
+    return results
+
+
+def bench_search(corpus_dir: Path, port: int, concurrency: list[int], requests: int):
+    results = asyncio.run(_bench_search(port, concurrency, requests))
+    sys.stdout.write(f"{'mode':<48}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}\n")
+    for name, elapsed, latencies in results:
+        p50, p99 = _percentile(latencies, 0.5) * 1000, _percentile(latencies, 0.99) * 1000
+        sys.stdout.write(f"{name:<48}{len(latencies) / elapsed:>10.1f}{p50:>10.2f}{p99:>10.2f}\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus-dir", type=Path, default=Path("bench_corpus"), help="Directory for the generated corpus")
+    subparsers = parser.add_subparsers(help="sub-command help")
+
+    ocr_pool_parser = subparsers.add_parser("ocr-pool", help="Compare the serial OCR loop with the supervised OCR workers")
+    ocr_pool_parser.add_argument("--files", type=int, default=64, help="Number of generated pages")
+    ocr_pool_parser.add_argument("--workers", type=int, nargs="+", default=[2, 4, 8], help="Worker counts to compare")
+    ocr_pool_parser.add_argument("--threads", type=int, default=1, help="Torch threads per worker")
+    ocr_pool_parser.add_argument("--page-batch", type=int, default=8, help="Pages per inference batch")
+    ocr_pool_parser.set_defaults(func=bench_ocr_pool)
+
+    inference_parser = subparsers.add_parser("inference", help="Compare throughput and word accuracy of the OCR inference modes")
+    inference_parser.add_argument("--files", type=int, default=32, help="Number of generated pages")
+    inference_parser.add_argument(
+        "--modes",
+        nargs="+",
+        default=[
+            "default",
+            "pixels-2m",
+            "preprocess",
+            "channels-last",
+            "quantize",
+            "compile",
+            "mobilenet",
+            "mobilenet+quantize+channels-last",
+        ],
+        help=f"Modes to compare, combinations of {', '.join(INFERENCE_MODES)} joined with +",
+    )
+    inference_parser.add_argument("--threads", type=int, default=0, help="Torch threads (0 keeps the torch default)")
+    inference_parser.add_argument("--page-batch", type=int, default=8, help="Pages per inference batch")
+    inference_parser.set_defaults(func=bench_inference)
+
+    pdf_text_parser = subparsers.add_parser("pdf-text", help="Compare PDF text layer extractors")
+    pdf_text_parser.add_argument("--files", type=int, default=4, help="Number of generated PDFs")
+    pdf_text_parser.add_argument("--pages", type=int, default=50, help="Pages per PDF")
+    pdf_text_parser.add_argument("--lines", type=int, default=60, help="Text lines per page")
+    pdf_text_parser.set_defaults(func=bench_pdf_text)
+
+    search_parser = subparsers.add_parser("search", help="Load test the executor and the async search paths against typesense-server")
+    search_parser.add_argument("--port", type=int, default=8108, help="Port of a running typesense-server with an indexed collection")
+    search_parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32], help="Concurrent clients to compare")
+    search_parser.add_argument("--requests", type=int, default=2000, help="Searches per run")
+    search_parser.set_defaults(func=bench_search)
+
+    args = parser.parse_args()
+    func = args.func
+    argdict = {k: v for k, v in args.__dict__.items() if v is not None}
+    argdict.pop("func")
+    func(**argdict)
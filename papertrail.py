@@ -1,27 +1,53 @@
+from __future__ import annotations
+
 import argparse
+import array
 import asyncio
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import copy
+import ctypes
+import ctypes.util
+import dataclasses
 import hashlib
+import heapq
+import itertools
 import json
+import math
+import mmap
+import multiprocessing
+import multiprocessing.connection
 import os
+import queue
+import re
+import select
 import shutil
-import socket
 import sqlite3
+import struct
 import subprocess
 import sys
 import threading
 import time
+import urllib.error
+import urllib.request
+import zlib
 from pathlib import Path
+from typing import TYPE_CHECKING, NamedTuple
 
 import aiohttp
 import aiohttp.web
-import doctr.io
-import doctr.models
-import doctr.models.predictor.pytorch
+import numpy
 import pypdfium2
 import typesense
 import typesense.client
 import typesense.exceptions
 
+# torch and doctr take seconds to import, they are only loaded by the code paths that run OCR
+if TYPE_CHECKING:
+    import doctr.models.predictor.pytorch
+
 
 class TypesenseBridgeException(Exception):
     pass
@@ -31,28 +57,1672 @@ class OCRException(Exception):
     pass
 
 
+class QuarantineException(OCRException):
+    pass
+
+
+TYPESENSE_API_KEY = "test"
+# Bump whenever the way documents are built changes so that persisted indexes get rebuilt
+INDEX_SCHEMA_VERSION = 1
+DOCUMENTS_SCHEMA: dict[str, object] = {
+    "name": "documents",
+    "fields": [
+        {"name": "filename", "type": "string", "infix": True},
+        {"name": "url", "type": "string"},
+        {"name": "tags", "type": "string[]", "facet": True},
+        {"name": "created_at", "type": "int32"},
+        {"name": "contents", "type": "string"},
+    ],
+    "default_sorting_field": "created_at",
+}
+# In dedup mode there is one document per md5 listing every copy of the file
+DEDUP_FIELDS: list[dict[str, object]] = [
+    {"name": "paths", "type": "string[]"},
+    {"name": "urls", "type": "string[]"},
+]
+
+
+# With page or chunk granularity a file is split into several documents that share a parent_id
+PIECE_FIELDS: list[dict[str, object]] = [
+    {"name": "parent_id", "type": "string", "facet": True},
+    {"name": "page", "type": "int32"},
+]
+INDEX_GRANULARITIES = ("document", "page", "chunk")
+
+
+def documents_schema(dedup: bool, granularity: str = "document") -> dict[str, object]:
+    fields = list(DOCUMENTS_SCHEMA["fields"])
+    if dedup:
+        fields += DEDUP_FIELDS
+    if granularity != "document":
+        fields += PIECE_FIELDS
+    return {**DOCUMENTS_SCHEMA, "fields": fields}
+
+
+# Search responses carry snippets only, full texts are fetched per page from /document/{id}/text
+SEARCH_PER_PAGE = 10
+SEARCH_MAX_PER_PAGE = 50
+SEARCH_MAX_PAGE = 100
+SNIPPET_TOKENS = 12
+SEARCH_PARAMETERS = ("q", "page", "per_page", "filter_by")
+
+
+def clamp_int(value: str | None, default: int, low: int, high: int) -> int:
+    try:
+        return min(max(int(value), low), high) if value is not None else default
+    except ValueError:
+        return default
+
+
+def compact_hit(hit: dict) -> dict[str, object]:
+    document = hit["document"]
+    snippet = next((highlight.get("snippet", "") for highlight in hit.get("highlights", []) if highlight.get("field") == "contents"), "")
+    compact: dict[str, object] = {
+        "id": document.get("parent_id", document["id"]),
+        "filename": document["filename"],
+        "url": document["url"].split("#", 1)[0],
+        "snippet": snippet,
+    }
+    if "urls" in document:
+        compact["urls"] = document["urls"]
+    if "page" in document:
+        compact["pages"] = [{"page": document["page"], "url": document["url"], "snippet": snippet}]
+    return compact
+
+
+def compact_search_result(result: dict) -> dict[str, object]:
+    hits: list[dict[str, object]] = []
+    if "grouped_hits" in result:
+        for group in result["grouped_hits"]:
+            pieces = [compact_hit(hit) for hit in group["hits"]]
+            for piece in pieces[1:]:
+                pieces[0]["pages"] += piece["pages"]
+            hits.extend(pieces[:1])
+    else:
+        hits = [compact_hit(hit) for hit in result.get("hits", [])]
+    return {"found": result.get("found", 0), "page": result.get("page", 1), "hits": hits}
+
+
+def page_text(contents: str, page_offsets: array.array, page: int) -> str:
+    end = page_offsets[page + 1] if page + 1 < len(page_offsets) else len(contents)
+    return contents[page_offsets[page] if page_offsets else 0 : end].strip()
+
+
+def split_pieces(contents: str, page_offsets: array.array, granularity: str, chunk_size: int) -> list[tuple[int, str]]:
+    # (page, text) for every index document of a file, chunks are cut at whitespace and report the page they start on
+    starts = list(page_offsets) or [0]
+    if granularity == "page":
+        return [(page, page_text(contents, page_offsets, page)) for page in range(len(starts))]
+    pieces: list[tuple[int, str]] = []
+    start = 0
+    while start < len(contents) or not pieces:
+        end = min(start + chunk_size, len(contents))
+        if end < len(contents):
+            cut = contents.rfind(" ", start, end)
+            cut = max(cut, contents.rfind("\n", start, end))
+            end = cut + 1 if cut > start else end
+        pieces.append((max(bisect.bisect_right(starts, start) - 1, 0), contents[start:end].strip()))
+        start = end
+    return pieces
+
+
+def document_id(fpath: Path) -> str:
+    return hashlib.sha1(fpath.as_posix().encode("utf-8")).hexdigest()
+
+
+def file_url(fpath: Path) -> str:
+    return (Path("/files") / fpath.relative_to(Path("/"))).as_posix()
+
+
+class TypesenseIndexer:
+    def __init__(self, client: typesense.Client, on_indexed, batch_size: int = 100, max_latency: float = 1.0, on_failed=None):
+        self.client = client
+        self.on_indexed = on_indexed
+        # on_failed(tokens, error) for documents typesense rejected
+        self.on_failed = on_failed
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self._queue: queue.Queue = queue.Queue(maxsize=batch_size * 4)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def add(self, document: dict[str, object], tokens: list | None = None, action: str = "upsert"):
+        # tokens are handed to on_indexed once the document has been imported
+        self._queue.put((document, tokens or [], action))
+
+    def flush(self):
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait()
+
+    def _run(self):
+        batch: list[tuple[dict[str, object], list, str]] = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if isinstance(item, tuple):
+                batch.append(item)
+                deadline = deadline or (time.monotonic() + self.max_latency)
+                if len(batch) < self.batch_size:
+                    continue
+            if batch:
+                self._import(batch)
+                batch = []
+                deadline = None
+            if isinstance(item, threading.Event):
+                item.set()
+
+    def _import(self, batch: list[tuple[dict[str, object], list, str]]):
+        # Consecutive documents with the same action share one import request
+        start = 0
+        while start < len(batch):
+            end = start
+            while end < len(batch) and batch[end][2] == batch[start][2]:
+                end += 1
+            self._import_run(batch[start:end], batch[start][2])
+            start = end
+
+    def _import_run(self, batch: list[tuple[dict[str, object], list, str]], action: str):
+        try:
+            results = self.client.collections["documents"].documents.import_([doc for doc, _, _ in batch], {"action": action})
+        except (typesense.exceptions.TypesenseClientError, OSError) as exc:
+            sys.stderr.write(f"Cannot import {len(batch)} documents: {str(exc)}\n")
+            if self.on_failed:
+                self.on_failed([token for _, tokens, _ in batch for token in tokens], str(exc))
+            return
+        indexed = []
+        for (doc, tokens, _), result in zip(batch, results):
+            if result.get("success", False):
+                indexed.extend(tokens)
+            else:
+                sys.stderr.write(f"Cannot index {doc.get('url', doc.get('id'))}: {result.get('error', 'unknown error')}\n")
+                if self.on_failed and tokens:
+                    self.on_failed(tokens, result.get("error", "unknown error"))
+        if indexed:
+            self.on_indexed(indexed)
+
+
+class TypesenseSearchClient:
+    # Searches over one pooled keep-alive session instead of a thread per query
+    def __init__(self, port: int, api_key: str, timeout: float = 2.0, max_concurrency: int = 32):
+        self.url = f"http://localhost:{port}/collections/documents/documents/search"
+        self.api_key = api_key
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self._session: aiohttp.ClientSession | None = None
+        self._slots: asyncio.Semaphore | None = None
+
+    async def search(self, params: dict[str, object]) -> dict:
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_concurrency, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={"X-TYPESENSE-API-KEY": self.api_key},
+            )
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+        query = {key: str(value) for key, value in params.items()}
+        # A cancelled handler (browser went away) cancels the request and frees its slot and connection
+        async with self._slots:
+            try:
+                async with self._session.get(self.url, params=query) as response:
+                    result = await response.json(content_type=None)
+                    if not response.ok:
+                        raise TypesenseBridgeException(f"Search failed ({response.status}): {result.get('message', '')}")
+                    return result
+            except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+                raise TypesenseBridgeException(f"Search failed: {str(exc)}") from exc
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class SearchCache:
+    # LRU of serialized search responses. Keys carry the index generation, so commits make older entries unreachable.
+    def __init__(self, max_entries: int = 256, ttl: float = 30.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: collections.OrderedDict[str, tuple[float, bytes]] = collections.OrderedDict()
+        self._inflight: dict[str, asyncio.Task] = {}
+
+    async def get(self, key: str, compute) -> bytes:
+        entry = self._entries.get(key)
+        if entry is not None and time.monotonic() - entry[0] < self.ttl:
+            self._entries.move_to_end(key)
+            return entry[1]
+        # Identical concurrent queries share one search; shielded so an aborted request does not cancel it for the others
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(compute())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._store(key, done))
+        return await asyncio.shield(task)
+
+    def _store(self, key: str, task: asyncio.Task):
+        self._inflight.pop(key, None)
+        if task.cancelled() or task.exception() is not None or self.max_entries == 0:
+            return
+        self._entries[key] = (time.monotonic(), task.result())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+def set_torch_threads(num_threads: int):
+    if num_threads > 0:
+        import torch  # noqa: PLC0415
+
+        torch.set_num_threads(num_threads)
+
+
+# Files with text to extract, everything else is indexed without contents
+IMAGE_SUFFIXES = (".jpg", ".png")
+EXTRACTABLE_SUFFIXES = (".pdf", *IMAGE_SUFFIXES)
+
+
+def needs_text_extraction(metadata_dir: Path) -> bool:
+    return len(list(metadata_dir.glob("*.textdata.json"))) == 0
+
+
+# Bump when the extraction code changes its output
+EXTRACT_VERSION = 1
+HASH_VERSION = "md5"
+
+
+@dataclasses.dataclass
+class ExtractionOptions:
+    # Settings shared by the analysis thread and the OCR worker processes
+    page_batch: int = 8
+    pdf_dpi: int = 144
+    # text-first: use the text layer and OCR only pages without enough text
+    # ocr: OCR every page, text: never OCR
+    pdf_text_policy: str = "text-first"
+    min_text_chars: int = 32
+    pdf_text_geometry: bool = False
+    # Keep every nth pixel of images, only set for quarantined files and not part of the version
+    image_step: int = 1
+    # Inference modes: lighter architectures (None keeps the doctr default), int8 recognition weights,
+    # inference_mode with channels-last weights, torch.compile. Only the first two change the extracted text.
+    det_arch: str | None = None
+    reco_arch: str | None = None
+    quantize: bool = False
+    channels_last: bool = False
+    compile_model: bool = False
+    # Preprocessing of page images before OCR: a pixel budget per page (0 keeps the full size),
+    # straightening of sideways and skewed pages, blank pages bypass the model
+    max_page_pixels: int = 0
+    deskew: bool = False
+    skip_blank: bool = False
+
+    def preprocessing(self) -> dict[str, object]:
+        # Recorded in every textdata file
+        return {"pdf_dpi": self.pdf_dpi, "max_page_pixels": self.max_page_pixels, "deskew": self.deskew, "skip_blank": self.skip_blank}
+
+    def version(self) -> str:
+        # Everything that changes the extracted text; a new version re-extracts existing documents
+        version = f"{EXTRACT_VERSION}:{self.pdf_dpi}:{self.pdf_text_policy}:{self.min_text_chars}:{int(self.pdf_text_geometry)}"
+        # The default model keeps the version it had before models were configurable
+        if self.det_arch or self.reco_arch or self.quantize:
+            version += f":{self.det_arch or 'default'}:{self.reco_arch or 'default'}:{'int8' if self.quantize else 'fp32'}"
+        if self.max_page_pixels or self.deskew or self.skip_blank:
+            version += f":px{self.max_page_pixels}:{int(self.deskew)}{int(self.skip_blank)}"
+        return version
+
+
+def create_ocr_predictor(options: ExtractionOptions) -> doctr.models.predictor.pytorch.OCRPredictor:
+    import doctr.models  # noqa: PLC0415
+
+    archs = {key: value for key, value in (("det_arch", options.det_arch), ("reco_arch", options.reco_arch)) if value}
+    predictor = doctr.models.ocr_predictor(**archs, pretrained=True, det_bs=options.page_batch)
+    if not (options.quantize or options.channels_last or options.compile_model):
+        return predictor
+    import torch  # noqa: PLC0415
+
+    if options.quantize:
+        # int8 weights for the linear and recurrent layers of the recognition model, activations stay fp32
+        predictor.reco_predictor.model = torch.ao.quantization.quantize_dynamic(
+            predictor.reco_predictor.model, {torch.nn.Linear, torch.nn.LSTM, torch.nn.GRU}, dtype=torch.qint8
+        )
+    if options.channels_last:
+        predictor.det_predictor.model.to(memory_format=torch.channels_last)
+        predictor.reco_predictor.model.to(memory_format=torch.channels_last)
+    if options.compile_model:
+        # Compiled kernels are cached next to the doctr weights and reused by later runs and the OCR workers
+        doctr_cache = Path(os.environ.get("DOCTR_CACHE_DIR", Path.home() / ".cache" / "doctr"))
+        os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", (doctr_cache / "inductor").as_posix())
+        predictor.det_predictor.model = torch.compile(predictor.det_predictor.model, dynamic=True)
+        predictor.reco_predictor.model = torch.compile(predictor.reco_predictor.model, dynamic=True)
+    return predictor
+
+
+class PageBatcher:
+    # Pages of many files are run through the predictor in fixed size batches
+    # and the per page results are handed back to each file as they complete.
+    # Pages that are already extracted (dicts) bypass the model but keep their order.
+    def __init__(self, model: doctr.models.predictor.pytorch.OCRPredictor, batch_size: int, on_page, on_done, inference_mode: bool = False):
+        self.model = model
+        self.batch_size = batch_size
+        self.inference_mode = inference_mode
+        self.on_page = on_page
+        self.on_done = on_done
+        self._pages: list[tuple[str, object]] = []
+        self._images = 0
+        self._receiving: set[str] = set()
+        self._started: set[str] = set()
+
+    def add(self, key: str, pages):
+        self._started.add(key)
+        self._receiving.add(key)
+        try:
+            for page in pages:
+                if isinstance(page, dict):
+                    if any(pkey == key for pkey, _ in self._pages):
+                        self._pages.append((key, page))
+                    else:
+                        self.on_page(key, page)
+                    continue
+                self._pages.append((key, page))
+                self._images += 1
+                if self._images >= self.batch_size:
+                    self._run()
+        except BaseException:
+            self._pages = [(pkey, page) for pkey, page in self._pages if pkey != key]
+            self._images = sum(1 for _, page in self._pages if not isinstance(page, dict))
+            self._started.discard(key)
+            raise
+        finally:
+            self._receiving.discard(key)
+        self._complete()
+
+    def flush(self):
+        if self._pages:
+            self._run()
+        self._complete()
+
+    def _run(self):
+        batch = self._pages
+        self._pages = []
+        self._images = 0
+        # Images come with the preprocessing that was applied to them
+        images = [page[0] if isinstance(page, tuple) else page for _, page in batch if not isinstance(page, dict)]
+        context = contextlib.nullcontext()
+        if images and self.inference_mode:
+            import torch  # noqa: PLC0415
+
+            context = torch.inference_mode()
+        with context:
+            try:
+                results = iter(self.model(images).pages if images else [])
+            except Exception as exc:
+                # The batch holds pages of several files, none of them can be told apart as the cause
+                raise OCRException(f"Inference failed on {len(images)} pages: {str(exc)}") from exc
+        for key, page in batch:
+            if isinstance(page, dict):
+                self.on_page(key, page)
+                continue
+            result = next(results).export()
+            if isinstance(page, tuple) and page[1]:
+                result["preprocessing"] = page[1]
+            self.on_page(key, result)
+        self._complete()
+
+    def _complete(self):
+        buffered = {key for key, _ in self._pages}
+        for key in [key for key in self._started if key not in self._receiving and key not in buffered]:
+            self._started.discard(key)
+            self.on_done(key)
+
+
+class TextDataWriter:
+    # Streams pages into a textdata json so that results never have to be held for the whole document
+    def __init__(self, fpath: Path, preprocessing: dict | None = None):
+        self.fpath = fpath
+        self._partial = fpath.with_name(fpath.name + ".partial")
+        self._file = self._partial.open("w")
+        self._file.write("{")
+        if preprocessing is not None:
+            self._file.write(f'"preprocessing": {json.dumps(preprocessing)}, ')
+        self._file.write('"pages": [')
+        self._count = 0
+
+    def append(self, page: dict):
+        if self._count > 0:
+            self._file.write(", ")
+        json.dump(page, self._file)
+        self._count += 1
+
+    def close(self):
+        self._file.write("]}")
+        self._file.close()
+        self._partial.replace(self.fpath)
+
+    def abort(self):
+        self._file.close()
+        self._partial.unlink(missing_ok=True)
+
+
+def pdf_text_page(page: pypdfium2.PdfPage, min_chars: int, geometry: bool = False) -> dict | None:
+    textpage = page.get_textpage()
+    if textpage.count_chars() < min_chars:
+        return None
+    # One call for the whole page, char boxes are looked up only for the ends of each word
+    text = textpage.get_text_range()
+    if min_chars > 0 and len("".join(text.split())) < min_chars:
+        return None
+    lines: list = []
+    for line_match in re.finditer(r"[^\r\n]+", text):
+        words: list = []
+        for word_match in re.finditer(r"\S+", line_match.group()):
+            word: dict[str, object] = {"value": word_match.group()}
+            if geometry:
+                first = textpage.get_charbox(line_match.start() + word_match.start())
+                last = textpage.get_charbox(line_match.start() + word_match.end() - 1)
+                word["geometry"] = [min(first[0], last[0]), min(first[1], last[1]), max(first[2], last[2]), max(first[3], last[3])]
+            words.append(word)
+        if words:
+            lines.append({"words": words})
+    return {"blocks": [{"lines": lines}] if lines else []}
+
+
+def pdf_page_count(fpath: Path) -> int:
+    pdf = pypdfium2.PdfDocument(fpath.as_posix())
+    try:
+        return len(pdf)
+    finally:
+        pdf.close()
+
+
+def pdf_pages(fpath: Path, options: ExtractionOptions, pages: tuple[int, int] | None = None):
+    pdf = pypdfium2.PdfDocument(fpath.as_posix())
+    try:
+        # The last page range of a segmented document may reach past its end
+        start, end = pages or (0, len(pdf))
+        for index in range(start, min(end, len(pdf))):
+            page = pdf[index]
+            if options.pdf_text_policy != "ocr":
+                min_chars = 0 if options.pdf_text_policy == "text" else options.min_text_chars
+                text_page = pdf_text_page(page, min_chars, options.pdf_text_geometry)
+                if text_page is not None or options.pdf_text_policy == "text":
+                    width, height = page.get_size()
+                    yield {"page_idx": index, "dimensions": [height, width], "source": "text", **(text_page or {"blocks": []})}
+                    page.close()
+                    continue
+            scale = options.pdf_dpi / 72
+            if options.max_page_pixels > 0:
+                # Rendered within the pixel budget rather than downsampled afterwards
+                width, height = page.get_size()
+                scale = min(scale, math.sqrt(options.max_page_pixels / (width * height)))
+            yield page.render(scale=scale, rev_byteorder=True).to_numpy()
+            page.close()
+    finally:
+        pdf.close()
+
+
+# Page heuristics look at a copy of about this many pixels on the long side
+PREPROCESS_SIZE = 800
+BLANK_INK_RATIO = 0.001
+DESKEW_MAX_ANGLE = 5.0
+DESKEW_STEP = 0.5
+
+
+def ink_profile_score(coords) -> float:
+    # Text lines make the ink profile across them peaky: the squared coefficient of variation of the counts
+    counts = numpy.bincount(numpy.round(coords - coords.min()).astype(numpy.int64))
+    return float(counts.var() / max(counts.mean(), 1e-9) ** 2)
+
+
+def estimate_orientation(ink) -> tuple[int, float]:
+    # Quarter turns (counterclockwise) that make the text lines horizontal, then the remaining skew in degrees.
+    # Up and down cannot be told apart this cheaply, sideways pages are assumed to be turned counterclockwise.
+    ys, xs = numpy.nonzero(ink)
+    if len(ys) < PREPROCESS_SIZE:
+        return 0, 0.0
+    turns = 0
+    if ink_profile_score(xs) > 2 * ink_profile_score(ys):
+        turns = -1
+        ys, xs = xs, ink.shape[0] - 1 - ys
+    angles = numpy.arange(-DESKEW_MAX_ANGLE, DESKEW_MAX_ANGLE + DESKEW_STEP / 2, DESKEW_STEP)
+    radians = numpy.radians(angles)
+    scores = [ink_profile_score(ys * math.cos(angle) + xs * math.sin(angle)) for angle in radians]
+    return turns, float(angles[int(numpy.argmax(scores))])
+
+
+def preprocess_page(image, options: ExtractionOptions) -> tuple[object, dict] | dict:
+    # The page image to OCR with the steps applied to it, or a finished page for blank ones.
+    # opencv comes with doctr and is only loaded by the OCR code paths like it.
+    import cv2  # noqa: PLC0415
+
+    info: dict[str, object] = {}
+    height, width = image.shape[:2]
+    if options.max_page_pixels > 0 and height * width > options.max_page_pixels * 1.01:
+        scale = math.sqrt(options.max_page_pixels / (height * width))
+        image = cv2.resize(image, (max(1, int(width * scale)), max(1, int(height * scale))), interpolation=cv2.INTER_AREA)
+        info["scale"] = round(scale, 3)
+    if not (options.deskew or options.skip_blank):
+        return image, info
+    step = max(1, max(image.shape[:2]) // PREPROCESS_SIZE)
+    gray = image[::step, ::step, :3].mean(axis=2)
+    ink = gray < gray.mean() * 0.75
+    if options.skip_blank and ink.mean() < BLANK_INK_RATIO:
+        return {"dimensions": [height, width], "source": "blank", "blocks": []}
+    if options.deskew:
+        turns, angle = estimate_orientation(ink)
+        if turns:
+            image = numpy.ascontiguousarray(numpy.rot90(image, turns))
+            info["rotation"] = 90 * turns
+        if abs(angle) >= DESKEW_STEP:
+            rows, cols = image.shape[:2]
+            matrix = cv2.getRotationMatrix2D((cols / 2, rows / 2), -angle, 1.0)
+            image = cv2.warpAffine(image, matrix, (cols, rows), flags=cv2.INTER_LINEAR, borderValue=(255, 255, 255))
+            info["skew"] = angle
+    return image, info
+
+
+def preprocess_pages(pages, options: ExtractionOptions):
+    for page in pages:
+        yield page if isinstance(page, dict) else preprocess_page(page, options)
+
+
+def load_pages(fpath: Path, options: ExtractionOptions, pages: tuple[int, int] | None = None):
+    if fpath.suffix.lower() in IMAGE_SUFFIXES:
+        import doctr.io  # noqa: PLC0415
+
+        images = doctr.io.DocumentFile.from_images(fpath.as_posix())
+        if options.image_step > 1:
+            images = [image[:: options.image_step, :: options.image_step] for image in images]
+        return preprocess_pages(images, options)
+    if fpath.suffix.lower() == ".pdf":
+        return preprocess_pages(pdf_pages(fpath, options, pages), options)
+    return []
+
+
+def textdata_name(fpath: Path) -> str:
+    return "pdf.textdata.json" if fpath.suffix.lower() == ".pdf" else "ocr.textdata.json"
+
+
+def segment_name(pages: tuple[int, int]) -> str:
+    return f"pdf.{pages[0]:06d}-{pages[1]:06d}.segment.json"
+
+
+def merge_segments(metadata_dir: Path, ranges: list[tuple[int, int]]) -> str:
+    # The page ranges of a PDF are extracted separately and joined once all of them are done.
+    # Segment files left by another segmentation (a changed --segment-pages) are not part of it.
+    segments = [metadata_dir / segment_name(pages) for pages in ranges]
+    preprocessing = json.loads(segments[0].read_text()).get("preprocessing") if segments else None
+    writer = TextDataWriter(metadata_dir / "pdf.textdata.json", preprocessing)
+    try:
+        for segment in segments:
+            for page in json.loads(segment.read_text())["pages"]:
+                writer.append(page)
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+    for segment in metadata_dir.glob("pdf.*.segment.json"):
+        segment.unlink()
+    return writer.fpath.name
+
+
+def extract_texts(
+    model: doctr.models.predictor.pytorch.OCRPredictor, jobs: list[tuple[str, str, tuple[int, int] | None]], options: ExtractionOptions
+) -> dict[str, list[str]]:
+    # jobs of (path, metadata dir, page range or None for the whole file)
+    actions: dict[str, list[str]] = {fpath: [] for fpath, _, _ in jobs}
+    outputs = {
+        fpath: Path(metadata_dir) / (segment_name(pages) if pages else textdata_name(Path(fpath))) for fpath, metadata_dir, pages in jobs
+    }
+    writers: dict[str, TextDataWriter] = {}
+
+    def on_page(fpath: str, page: dict):
+        if fpath not in writers:
+            writers[fpath] = TextDataWriter(outputs[fpath], options.preprocessing())
+        page.setdefault("source", "ocr")
+        writers[fpath].append(page)
+
+    def on_done(fpath: str):
+        if fpath in writers:
+            writer = writers.pop(fpath)
+            writer.close()
+            actions[fpath].append(writer.fpath.name)
+
+    batcher = PageBatcher(model, options.page_batch, on_page, on_done, options.channels_last)
+    try:
+        for fpath, _, pages in jobs:
+            try:
+                if pages is not None:
+                    # The analysis thread splits a document into page ranges once it knows the page count
+                    actions[fpath].append(f"pages={pdf_page_count(Path(fpath))}")
+                batcher.add(fpath, load_pages(Path(fpath), options, pages))
+            except OCRException:
+                raise
+            except Exception as exc:  # Unreadable files (pdfium errors, doctr's ValueError, cv2.error) only fail themselves
+                sys.stderr.write(f"Error Processing {fpath}: {str(exc)}\n")
+                actions[fpath].append(f"error={str(exc)}")
+                if fpath in writers:
+                    writers.pop(fpath).abort()
+        batcher.flush()
+    finally:
+        for writer in writers.values():
+            writer.abort()
+    return actions
+
+
+def available_cpus() -> int:
+    # CPUs this process may use: the affinity mask, further capped by a cgroup v2 cpu.max quota
+    cpus = len(os.sched_getaffinity(0))
+    try:
+        quota, period = Path("/sys/fs/cgroup/cpu.max").read_text().split()
+        if quota != "max":
+            cpus = min(cpus, max(1, math.ceil(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+
+class ResourceGovernor:
+    # Decides how much CPU background analysis gets. In latency mode analysis uses half of the CPUs
+    # and pauses (then continues with single-file jobs) while searches arrive or the event loop lags.
+    MODES = ("latency", "throughput")
+    RATE_WINDOW = 60.0
+
+    def __init__(self, mode: str = "latency", cpus: int = 0, nice: int = 10, lag_threshold: float = 0.05, quiet_period: float = 2.0):
+        self.mode = mode
+        self.cpus = cpus or available_cpus()
+        self.nice = nice
+        self.lag_threshold = lag_threshold
+        self.quiet_period = quiet_period
+        self.max_pause = 10.0
+        self.loop_lag = 0.0
+        self._last_search = 0.0
+        self._searches: collections.deque = collections.deque(maxlen=1000)
+
+    def cpu_budget(self) -> int:
+        return self.cpus if self.mode == "throughput" else max(1, self.cpus // 2)
+
+    def note_search(self):
+        self._last_search = time.monotonic()
+        self._searches.append(self._last_search)
+
+    def note_loop_lag(self, lag: float):
+        self.loop_lag = 0.8 * self.loop_lag + 0.2 * lag
+
+    def throttled(self) -> bool:
+        if self.mode == "throughput":
+            return False
+        return self.loop_lag > self.lag_threshold or time.monotonic() - self._last_search < self.quiet_period
+
+    def wait(self, cancelled=None) -> bool:
+        # Returns whether analysis had to yield; a pause is capped so that constant traffic cannot starve analysis
+        deadline = time.monotonic() + self.max_pause
+        throttled = self.throttled()
+        while self.throttled() and time.monotonic() < deadline and not (cancelled and cancelled()):
+            time.sleep(0.1)
+        return throttled
+
+    def job_size(self, page_batch: int) -> int:
+        return 1 if self.throttled() else page_batch
+
+    def snapshot(self) -> dict[str, object]:
+        now = time.monotonic()
+        return {
+            "mode": self.mode,
+            "cpus": self.cpus,
+            "cpu_budget": self.cpu_budget(),
+            "nice": self.nice,
+            "throttled": self.throttled(),
+            "loop_lag_ms": round(self.loop_lag * 1000, 1),
+            "searches_per_minute": sum(1 for stamp in self._searches if now - stamp < self.RATE_WINDOW),
+        }
+
+
+def lower_thread_priority(nice: int):
+    # Linux niceness is per thread and inherited by threads created afterwards (torch, hashing pools)
+    if nice > 0:
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), nice)
+        except OSError:
+            pass
+
+
+# Each OCR worker process loads its own predictor once and reuses it for every job
+_worker_model: doctr.models.predictor.pytorch.OCRPredictor | None = None
+_worker_options: ExtractionOptions = ExtractionOptions()
+
+
+def _ocr_worker_init(num_threads: int, options: ExtractionOptions, nice: int = 0):
+    global _worker_model, _worker_options  # noqa: PLW0603
+    lower_thread_priority(nice)
+    set_torch_threads(num_threads)
+    _worker_model = create_ocr_predictor(options)
+    _worker_options = options
+
+
+def _ocr_worker_run(
+    jobs: list[tuple[str, str, tuple[int, int] | None]], options: ExtractionOptions | None = None, num_threads: int = 0
+) -> dict[str, list[str]]:
+    # The thread budget comes with every job so that governor mode changes reach running workers
+    set_torch_threads(num_threads)
+    return extract_texts(_worker_model, jobs, options or _worker_options)
+
+
+def _ocr_worker_main(conn: multiprocessing.connection.Connection, num_threads: int, options: ExtractionOptions, nice: int):
+    _ocr_worker_init(num_threads, options, nice)
+    conn.send(("ready", None))
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            return
+        if request is None:
+            return
+        try:
+            conn.send(("done", _ocr_worker_run(*request)))
+        except Exception as exc:  # Handed back to the analysis thread like a ProcessPoolExecutor would
+            conn.send(("error", exc))
+
+
+def process_rss(pid: int) -> int:
+    try:
+        return int(Path(f"/proc/{pid}/statm").read_text().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+class OCRSupervisor:
+    # OCR worker processes that are watched while they run a job. A worker that exceeds the wall-clock
+    # limit of its job (timeout seconds per file) or the RSS limit is killed, a crashed one is replaced,
+    # and the job fails with a QuarantineException so its files can be isolated and quarantined.
+    def __init__(self, workers: int, initargs: tuple, timeout: float, max_rss: int, poll_interval: float = 0.5):
+        self.initargs = initargs
+        self.timeout = timeout
+        self.max_rss = max_rss
+        self.poll_interval = poll_interval
+        self._context = multiprocessing.get_context("spawn")
+        self._requests: queue.Queue = queue.Queue()
+        self._threads = [threading.Thread(target=self._supervise, daemon=True) for _ in range(workers)]
+        for thrd in self._threads:
+            thrd.start()
+
+    def submit(
+        self, jobs: list[tuple[str, str, tuple[int, int] | None]], options: ExtractionOptions | None = None, num_threads: int = 0
+    ) -> concurrent.futures.Future:
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        self._requests.put((future, jobs, options, num_threads))
+        return future
+
+    def shutdown(self):
+        for _ in self._threads:
+            self._requests.put(None)
+
+    def _start_worker(self):
+        conn, child_conn = self._context.Pipe()
+        process = self._context.Process(target=_ocr_worker_main, args=(child_conn, *self.initargs), daemon=True)
+        process.start()
+        child_conn.close()
+        # Loading the model is not part of any job's time limit
+        while not conn.poll(self.poll_interval):
+            if not process.is_alive():
+                raise OCRException(f"OCR worker exited with code {process.exitcode} while starting")
+        conn.recv()
+        return process, conn
+
+    def _stop_worker(self, process, conn):
+        conn.close()
+        process.kill()
+        process.join()
+
+    def _supervise(self):
+        worker = None
+        with contextlib.suppress(OCRException, OSError):
+            # Started right away so the model is loaded before the first job, a failure is retried with the first job
+            worker = self._start_worker()
+        while (request := self._requests.get()) is not None:
+            future, jobs, options, num_threads = request
+            try:
+                worker = worker or self._start_worker()
+            except (OCRException, OSError) as exc:
+                future.set_exception(OCRException(f"Cannot start OCR worker: {str(exc)}"))
+                continue
+            try:
+                worker[1].send((jobs, options, num_threads))
+                status, result = self._wait(*worker, self.timeout * len(jobs))
+            except (QuarantineException, OSError, EOFError) as exc:
+                self._stop_worker(*worker)
+                worker = None
+                future.set_exception(exc if isinstance(exc, QuarantineException) else QuarantineException(f"OCR worker died: {str(exc)}"))
+                continue
+            if status == "error":
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+        if worker is not None:
+            with contextlib.suppress(OSError):
+                worker[1].send(None)
+            worker[0].join(self.poll_interval)
+            self._stop_worker(*worker)
+
+    def _wait(self, process, conn, limit: float):
+        deadline = time.monotonic() + limit
+        while not conn.poll(self.poll_interval):
+            if not process.is_alive():
+                raise QuarantineException(f"OCR worker exited with code {process.exitcode}")
+            if time.monotonic() > deadline:
+                raise QuarantineException(f"timed out after {limit:.0f}s")
+            rss = process_rss(process.pid)
+            if self.max_rss > 0 and rss > self.max_rss:
+                raise QuarantineException(f"exceeded the memory limit with {rss // (1 << 20)} MB")
+        try:
+            return conn.recv()
+        except EOFError:
+            process.join(self.poll_interval)
+            raise QuarantineException(f"OCR worker exited with code {process.exitcode}") from None
+
+
+# Columnar word layout of a document: header, word ranges per page, then one array per attribute
+WORDS_FILE = "words.bin"
+WORDS_HEADER = struct.Struct("<4sII")
+WORDS_MAGIC = b"PTW1"
+
+
+def textdata_sources(metadata_dir: Path) -> str:
+    # Identifies the textdata files that a stored text was built from
+    return json.dumps([[fpath.name, fpath.stat().st_mtime_ns] for fpath in sorted(metadata_dir.glob("*.textdata.json"))])
+
+
+def word_box(geometry: list | None) -> tuple[float, float, float, float]:
+    if not geometry:
+        return (float("nan"),) * 4
+    if isinstance(geometry[0], (list, tuple)):
+        xs = [point[0] for point in geometry]
+        ys = [point[1] for point in geometry]
+        return (min(xs), min(ys), max(xs), max(ys))
+    return tuple(geometry[:4])
+
+
+def build_text_store(metadata_dir: Path) -> tuple[str, array.array]:
+    # Flattens every textdata file of a document into plain text with page offsets and writes the word boxes next to it
+    parts: list[str] = []
+    length = 0
+    page_offsets = array.array("I")
+    page_words = array.array("I", [0])
+    word_starts = array.array("I")
+    word_lengths = array.array("I")
+    boxes = array.array("f")
+    for text_data in sorted(metadata_dir.glob("*.textdata.json")):
+        for page in json.loads(text_data.read_text())["pages"]:
+            if parts:
+                parts.append("\n\n")
+                length += 2
+            page_offsets.append(length)
+            for block_index, block in enumerate(page["blocks"]):
+                if block_index > 0:
+                    parts.append("\n\n")
+                    length += 2
+                for line_index, line in enumerate(block["lines"]):
+                    if line_index > 0:
+                        parts.append("\n")
+                        length += 1
+                    for word_index, word in enumerate(line["words"]):
+                        if word_index > 0:
+                            parts.append(" ")
+                            length += 1
+                        word_starts.append(length)
+                        word_lengths.append(len(word["value"]))
+                        boxes.extend(word_box(word.get("geometry")))
+                        parts.append(word["value"])
+                        length += len(word["value"])
+            page_words.append(len(word_starts))
+    words_file = metadata_dir / WORDS_FILE
+    # The web handlers and the analysis thread may build the same document at once, each writes its own file
+    partial = words_file.with_name(f"{WORDS_FILE}.{os.getpid()}.{threading.get_native_id()}.partial")
+    with partial.open("wb") as fd:
+        fd.write(WORDS_HEADER.pack(WORDS_MAGIC, len(page_offsets), len(word_starts)))
+        for column in (page_words, word_starts, word_lengths, boxes):
+            column.tofile(fd)
+    partial.replace(words_file)
+    return "".join(parts), page_offsets
+
+
+def load_word_boxes(metadata_dir: Path, page: int) -> list[tuple[int, int, tuple[float, ...]]]:
+    # Reads only the slices of the columns that belong to one page
+    try:
+        fd = (metadata_dir / WORDS_FILE).open("rb")
+    except FileNotFoundError:
+        return []
+    with fd:
+        magic, pages, words = WORDS_HEADER.unpack(fd.read(WORDS_HEADER.size))
+        if magic != WORDS_MAGIC or page < 0 or page >= pages:
+            return []
+        page_words = array.array("I")
+        fd.seek(WORDS_HEADER.size + page * 4)
+        page_words.fromfile(fd, 2)
+        first, count = page_words[0], page_words[1] - page_words[0]
+        columns_start = WORDS_HEADER.size + (pages + 1) * 4
+        word_starts, word_lengths, boxes = array.array("I"), array.array("I"), array.array("f")
+        fd.seek(columns_start + first * 4)
+        word_starts.fromfile(fd, count)
+        fd.seek(columns_start + words * 4 + first * 4)
+        word_lengths.fromfile(fd, count)
+        fd.seek(columns_start + words * 8 + first * 16)
+        boxes.fromfile(fd, count * 4)
+    return [(word_starts[i], word_starts[i] + word_lengths[i], tuple(boxes[i * 4 : i * 4 + 4])) for i in range(count)]
+
+
+HASH_READ_SIZE = 1 << 20
+
+
+def hash_file(fpath: Path) -> str:
+    # hashlib drops the GIL for large buffers, so hashing threads run in parallel
+    hash_md5 = hashlib.md5()
+    with fpath.open("rb") as f:
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                hash_md5.update(mapped)
+        except (ValueError, OSError):
+            # Empty files and filesystems that cannot be mapped
+            for chunk in iter(lambda: f.read(HASH_READ_SIZE), b""):
+                hash_md5.update(chunk)
+    return hash_md5.hexdigest()
+
+
+def timed_hash_file(fpath: Path) -> tuple[str, float]:
+    start = time.perf_counter()
+    return hash_file(fpath), time.perf_counter() - start
+
+
+def scan_tree(root: str, workers: int = 8, failed: list[str] | None = None):
+    # Walks subtrees in parallel and yields lists of (path, device, inode, size, mtime) per directory.
+    # Directory entries come with their file type, so only regular files cost a stat call.
+    # Directories that cannot be read are appended to failed, their contents are unknown rather than gone.
+    results: queue.Queue = queue.Queue(maxsize=1024)
+    lock = threading.Lock()
+    outstanding = [1]
+    stopped = threading.Event()
+
+    def walk(dirpath: str):
+        entries: list[tuple[str, int, int, int, float]] = []
+        if stopped.is_set():
+            results.put(entries)
+            with lock:
+                outstanding[0] -= 1
+                if outstanding[0] == 0:
+                    results.put(None)
+            return
+        try:
+            with os.scandir(dirpath) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            with lock:
+                                outstanding[0] += 1
+                            pool.submit(walk, entry.path)
+                        elif entry.is_file():
+                            fstat = entry.stat()
+                            entries.append((entry.path, fstat.st_dev, fstat.st_ino, fstat.st_size, fstat.st_mtime))
+                    except OSError:
+                        if failed is not None:
+                            failed.append(entry.path)
+                        continue
+        except OSError as exc:
+            sys.stderr.write(f"Cannot scan {dirpath}: {str(exc)}\n")
+            if failed is not None:
+                failed.append(dirpath)
+        results.put(entries)
+        with lock:
+            outstanding[0] -= 1
+            if outstanding[0] == 0:
+                results.put(None)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        pool.submit(walk, root)
+        finished = False
+        try:
+            while (entries := results.get()) is not None:
+                if entries:
+                    yield entries
+            finished = True
+        finally:
+            # A consumer that stops early lets the queued walks drain without descending further
+            stopped.set()
+            while not finished and results.get() is not None:
+                pass
+
+
+class InotifyWatcher:
+    # Linux inotify through libc. Every directory under the roots gets a watch and
+    # changed paths are reported once they have been quiet for the debounce interval.
+    # Files that are written to wait for their writer to close them, up to the write timeout.
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+    EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self, roots: list[Path], on_changes, on_overflow, debounce: float = 2.0, write_timeout: float = 300.0):
+        self.roots = roots
+        self.on_changes = on_changes
+        self.on_overflow = on_overflow
+        self.debounce = debounce
+        self.write_timeout = write_timeout
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self._fd < 0:
+            raise TypesenseBridgeException(f"Cannot initialize inotify: {os.strerror(ctypes.get_errno())}")
+        self._watches: dict[int, Path] = {}
+        self._pending: dict[Path, float] = {}
+        # Files modified since their writer last closed them
+        self._writing: set[Path] = set()
+        for root in roots:
+            self._watch_tree(root)
+
+    def _watch_tree(self, root: Path):
+        for dirpath, _, _ in os.walk(root):
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(dirpath), self.WATCH_MASK | self.IN_ONLYDIR)
+            if wd < 0:
+                sys.stderr.write(f"Cannot watch {dirpath}: {os.strerror(ctypes.get_errno())}\n")
+                continue
+            self._watches[wd] = Path(dirpath)
+
+    def run(self, stop_requested: threading.Event):
+        try:
+            while not stop_requested.is_set():
+                readable, _, _ = select.select([self._fd], [], [], min(self.debounce, 1.0))
+                if readable:
+                    self._read_events()
+                self._flush_quiet()
+        finally:
+            os.close(self._fd)
+
+    def _read_events(self):
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        now = time.monotonic()
+        while offset < len(data):
+            wd, mask, _, length = self.EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + self.EVENT_HEADER.size : offset + self.EVENT_HEADER.size + length].rstrip(b"\0")
+            offset += self.EVENT_HEADER.size + length
+            if mask & self.IN_Q_OVERFLOW:
+                sys.stderr.write("Inotify queue overflowed, rescanning\n")
+                self.on_overflow()
+                continue
+            if mask & self.IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            dirpath = self._watches.get(wd)
+            if dirpath is None:
+                continue
+            fpath = dirpath / os.fsdecode(name) if name else dirpath
+            if mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                self._watch_tree(fpath)
+            if mask & self.IN_MODIFY:
+                self._writing.add(fpath)
+            elif mask & (self.IN_CLOSE_WRITE | self.IN_DELETE | self.IN_MOVED_FROM):
+                self._writing.discard(fpath)
+            self._pending[fpath] = now
+
+    def _flush_quiet(self):
+        now = time.monotonic()
+        quiet = [
+            fpath
+            for fpath, last_event in self._pending.items()
+            if last_event <= now - (self.write_timeout if fpath in self._writing else self.debounce)
+        ]
+        if not quiet:
+            return
+        for fpath in quiet:
+            del self._pending[fpath]
+            self._writing.discard(fpath)
+        try:
+            self.on_changes(quiet)
+        except Exception as exc:  # A failed batch must not end the watch, the reconcile scan catches up on it
+            sys.stderr.write(f"Cannot apply {len(quiet)} changes: {str(exc)}\n")
+
+
+class PaperTrailDatabase:
+    # data.sqlite is shared by the scan, analysis, indexer and web threads.
+    # Each thread keeps its own connection and WAL lets readers run alongside the writer.
+    def __init__(self, db_file: Path, batch_size: int = 1000):
+        self.db_file = db_file
+        self.batch_size = batch_size
+        self._local = threading.local()
+
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            return conn
+        for i in range(10):
+            try:
+                conn = sqlite3.connect(self.db_file.as_posix(), timeout=30, detect_types=sqlite3.PARSE_DECLTYPES)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                self._local.conn = conn
+                return conn
+            except sqlite3.Error:
+                sys.stderr.write(f"Cannot open sqlite. Attempt {i}. Retrying in 5s")
+                time.sleep(5)
+        raise TypesenseBridgeException("Cannot open sqlite")
+
+    def create_schema(self):
+        conn = self.connection()
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS fileinfo (path text PRIMARY KEY, lastmodified INTEGER, size INTEGER, md5hash char(32))"
+            )
+            # Mirror of the fileinfo state that was last pushed to typesense
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS indexinfo"
+                " (path text PRIMARY KEY, docid text, lastmodified INTEGER, size INTEGER, md5hash char(32))"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS settings (key text PRIMARY KEY, value text)")
+            # Lookups by content (shared metadata dirs, duplicates); path lookups and
+            # subtree range scans are served by the primary keys
+            conn.execute("CREATE INDEX IF NOT EXISTS fileinfo_md5hash ON fileinfo (md5hash)")
+            self._add_missing_columns(conn, "fileinfo", {"device": "INTEGER", "inode": "INTEGER"})
+            # Content hashes by file identity. Rows outlive fileinfo entries so that renamed
+            # or moved files are matched to their existing metadata without hashing again.
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS fingerprints"
+                " (device INTEGER, inode INTEGER, size INTEGER, lastmodified INTEGER, md5hash char(32), PRIMARY KEY (device, inode))"
+            )
+            # Pipeline ledger: the last outcome of every stage of every file. Failed stages are retried
+            # with exponential backoff and stages whose version changed are run again.
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS pipeline (path text, stage text, version text, state text, md5hash char(32),"
+                " duration REAL, error text, attempts INTEGER, next_retry REAL, updated REAL, PRIMARY KEY (path, stage))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS pipeline_md5hash ON pipeline (md5hash, stage)")
+            # Plain text per content (zlib) with the character offset of every page
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS textstore (md5hash char(32) PRIMARY KEY, sources text, contents blob, page_offsets blob)"
+            )
+            # Files whose extraction hung, crashed or ran out of memory. attempts selects the fallback the next extraction uses,
+            # state becomes recovered once a fallback worked.
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS quarantine"
+                " (path text PRIMARY KEY, md5hash char(32), reason text, attempts INTEGER, state text, updated REAL)"
+            )
+
+    def _add_missing_columns(self, conn: sqlite3.Connection, table: str, columns: dict[str, str]):
+        existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+        for name, decl in columns.items():
+            if name not in existing:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {decl}")
+
+    def _executemany_chunked(self, sql: str, rows):
+        conn = self.connection()
+        chunk: list = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= self.batch_size:
+                with conn:
+                    conn.executemany(sql, chunk)
+                chunk = []
+        if chunk:
+            with conn:
+                conn.executemany(sql, chunk)
+
+    def get_setting(self, key: str) -> str | None:
+        row = self.connection().execute("select value from settings where key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_setting(self, key: str, value: str):
+        with self.connection() as conn:
+            conn.execute("insert or replace into settings values(?,?)", (key, value))
+
+    def get_file(self, fpath: Path) -> tuple | None:
+        return self.connection().execute("select * from fileinfo where path = ?", (fpath.as_posix(),)).fetchone()
+
+    def get_files_under(self, root: str) -> dict[str, tuple]:
+        # Paths under a directory form a contiguous range of the primary key
+        prefix = root.rstrip("/") + "/"
+        rows = self.connection().execute(
+            "select path, lastmodified, size, device, inode from fileinfo where path >= ? and path < ?", (prefix, prefix[:-1] + "0")
+        )
+        return {row[0]: row[1:] for row in rows}
+
+    def add_files(self, rows):
+        # rows of (path, lastmodified, size, device, inode)
+        self._executemany_chunked(
+            "insert or ignore into fileinfo (path, lastmodified, size, md5hash, device, inode) values(?,?,?,'',?,?)", rows
+        )
+
+    def update_modified_files(self, rows):
+        # rows of (lastmodified, size, device, inode, path), the content needs to be hashed again
+        self._executemany_chunked(
+            "update fileinfo set lastmodified = ?, size = ?, md5hash = '', device = ?, inode = ? where path = ?", rows
+        )
+
+    def update_file_ids(self, rows):
+        # rows of (device, inode, path)
+        self._executemany_chunked("update fileinfo set device = ?, inode = ? where path = ?", rows)
+
+    def find_fingerprint(self, device: int, inode: int, size: int, mtime: float) -> str | None:
+        row = (
+            self.connection()
+            .execute(
+                "select md5hash from fingerprints where device = ? and inode = ? and size = ? and lastmodified = ?",
+                (device, inode, size, mtime),
+            )
+            .fetchone()
+        )
+        return row[0] if row else None
+
+    def record_hash(self, fpath: Path, fstat: os.stat_result, md5sum: str):
+        with self.connection() as conn:
+            conn.execute(
+                "update fileinfo set lastmodified = ?, size = ?, md5hash = ?, device = ?, inode = ? where path = ?",
+                (fstat.st_mtime, fstat.st_size, md5sum, fstat.st_dev, fstat.st_ino, fpath.as_posix()),
+            )
+            conn.execute(
+                "insert or replace into fingerprints values(?,?,?,?,?)", (fstat.st_dev, fstat.st_ino, fstat.st_size, fstat.st_mtime, md5sum)
+            )
+
+    def remove_files(self, paths):
+        paths = list(paths)
+        self._executemany_chunked("delete from fileinfo where path = ?", ((path,) for path in paths))
+        self._executemany_chunked("delete from pipeline where path = ?", ((path,) for path in paths))
+        self._executemany_chunked("delete from quarantine where path = ?", ((path,) for path in paths))
+
+    def update_file(self, fpath: Path, mtime: float, size: int, md5sum: str):
+        with self.connection() as conn:
+            conn.execute(
+                "update fileinfo set lastmodified = ?, size = ?, md5hash = ? where path = ?", (mtime, size, md5sum, fpath.as_posix())
+            )
+
+    def remove_file(self, fpath: Path):
+        with self.connection() as conn:
+            conn.execute("delete from fileinfo where path = ?", (fpath.as_posix(),))
+            conn.execute("delete from pipeline where path = ?", (fpath.as_posix(),))
+            conn.execute("delete from quarantine where path = ?", (fpath.as_posix(),))
+
+    def get_pending_files(self, versions: dict[str, str] | None = None) -> dict[Path, str]:
+        return {fpath: md5sum for fpath, md5sum, _, _ in self.get_pending_work(versions)}
+
+    def get_pending_work(self, versions: dict[str, str] | None = None) -> list[tuple[Path, str, int, int]]:
+        # (path, md5hash, lastmodified, size) of files not indexed in their current state, with an outdated stage,
+        # or with a failed stage that is due for a retry.
+        # Failures still backing off are left alone unless the file changed since.
+        versions = versions or {}
+        outdated = " or ".join(
+            "exists (select 1 from pipeline p where p.path = f.path and p.stage = ? and p.version != ?)" for _ in versions
+        )
+        rows = self.connection().execute(
+            "select f.path, f.md5hash, f.lastmodified, f.size from fileinfo f left join indexinfo i on i.path = f.path"
+            " where (i.path is null or i.md5hash != f.md5hash or i.lastmodified != f.lastmodified or i.size != f.size"
+            f" {'or ' + outdated if outdated else ''}"
+            " or exists (select 1 from pipeline p where p.path = f.path and p.state = 'failed' and p.next_retry <= ?))"
+            " and not exists (select 1 from pipeline p where p.path = f.path and p.state = 'failed'"
+            " and p.next_retry > ? and p.md5hash = f.md5hash)",
+            (*[value for item in versions.items() for value in item], time.time(), time.time()),
+        )
+        return [(Path(row[0]), row[1], row[2] or 0, row[3] or 0) for row in rows]
+
+    def record_stages(self, rows: list[tuple[str, str, str, str, str | None, float, str]]):
+        # rows of (path, stage, version, state, md5hash, duration, error); failures back off from a minute up to a day.
+        # Without an md5hash the current one of the file is recorded.
+        now = time.time()
+        self._executemany_chunked(
+            "insert into pipeline values (?, ?, ?, ?, coalesce(?, (select md5hash from fileinfo where path = ?)), ?, ?, ?, ?, ?)"
+            " on conflict (path, stage) do update set"
+            " version = excluded.version, state = excluded.state, md5hash = excluded.md5hash, duration = excluded.duration,"
+            " error = excluded.error, attempts = case when excluded.state = 'failed' then attempts + 1 else 0 end,"
+            " next_retry = case when excluded.state = 'failed' then ? + min(60 * (1 << min(attempts, 10)), 86400) else 0 end,"
+            " updated = excluded.updated",
+            (
+                (
+                    path,
+                    stage,
+                    version,
+                    state,
+                    md5sum,
+                    path,
+                    duration,
+                    error,
+                    int(state == "failed"),
+                    (now + 60) * (state == "failed"),
+                    now,
+                    now,
+                )
+                for path, stage, version, state, md5sum, duration, error in rows
+            ),
+        )
+
+    def get_content_stage(self, md5sum: str, stage: str) -> tuple[str, str] | None:
+        return (
+            self.connection()
+            .execute(
+                "select version, state from pipeline where md5hash = ? and stage = ? order by updated desc limit 1",
+                (md5sum, stage),
+            )
+            .fetchone()
+        )
+
+    def get_next_retry(self) -> float | None:
+        row = self.connection().execute("select min(next_retry) from pipeline where state = 'failed'").fetchone()
+        return row[0] if row else None
+
+    def get_pipeline_summary(self, limit: int) -> dict[str, object]:
+        conn = self.connection()
+        stages: dict[str, dict[str, int]] = {}
+        for stage, state, count in conn.execute("select stage, state, count(*) from pipeline group by stage, state"):
+            stages.setdefault(stage, {})[state] = count
+        failures = [
+            {"path": row[0], "stage": row[1], "error": row[2], "attempts": row[3], "next_retry": row[4]}
+            for row in conn.execute(
+                "select path, stage, error, attempts, next_retry from pipeline where state = 'failed' order by updated desc limit ?",
+                (limit,),
+            )
+        ]
+        quarantined = [
+            {"path": row[0], "reason": row[1], "attempts": row[2], "state": row[3]}
+            for row in conn.execute("select path, reason, attempts, state from quarantine order by updated desc limit ?", (limit,))
+        ]
+        return {"stages": stages, "failures": failures, "quarantine": quarantined}
+
+    def quarantine_file(self, fpath: Path, md5sum: str, reason: str):
+        # A changed file starts over without fallbacks
+        with self.connection() as conn:
+            conn.execute(
+                "insert into quarantine values (?, ?, ?, 1, 'quarantined', ?) on conflict (path) do update set"
+                " attempts = case when md5hash = excluded.md5hash then attempts + 1 else 1 end,"
+                " md5hash = excluded.md5hash, reason = excluded.reason, state = excluded.state, updated = excluded.updated",
+                (fpath.as_posix(), md5sum, reason, time.time()),
+            )
+
+    def get_quarantine(self, fpath: Path, md5sum: str) -> tuple[str, int, str] | None:
+        # (reason, attempts, state) while the file has the contents it was quarantined with
+        row = (
+            self.connection()
+            .execute("select reason, attempts, state from quarantine where path = ? and md5hash = ?", (fpath.as_posix(), md5sum))
+            .fetchone()
+        )
+        return (row[0], row[1], row[2]) if row else None
+
+    def set_quarantine_state(self, fpath: Path, state: str):
+        with self.connection() as conn:
+            conn.execute("update quarantine set state = ?, updated = ? where path = ?", (state, time.time(), fpath.as_posix()))
+
+    def mark_indexed(self, indexed: list[tuple[Path, str, int, int, str]]):
+        # rows of (path, docid, lastmodified, size, md5hash) as they were when the document was queued
+        self._executemany_chunked(
+            "insert or replace into indexinfo values(?,?,?,?,?)",
+            ((fpath.as_posix(), docid, mtime, size, md5sum) for fpath, docid, mtime, size, md5sum in indexed),
+        )
+
+    def clear_index(self):
+        with self.connection() as conn:
+            conn.execute("delete from indexinfo")
+
+    def get_stale_index_entries(self, changed_content: bool = False) -> list[tuple[str, str]]:
+        condition = "f.path is null or f.md5hash != i.md5hash" if changed_content else "f.path is null"
+        return (
+            self.connection()
+            .execute(f"select i.path, i.docid from indexinfo i left join fileinfo f on f.path = i.path where {condition}")
+            .fetchall()
+        )
+
+    def get_text(self, md5sum: str) -> tuple[str, str, array.array] | None:
+        row = self.connection().execute("select sources, contents, page_offsets from textstore where md5hash = ?", (md5sum,)).fetchone()
+        if row is None:
+            return None
+        return row[0], zlib.decompress(row[1]).decode("utf-8"), array.array("I", row[2])
+
+    def put_text(self, md5sum: str, sources: str, contents: str, page_offsets: array.array):
+        conn = self.connection()
+        with conn:
+            conn.execute(
+                "insert or replace into textstore values(?,?,?,?)",
+                (md5sum, sources, zlib.compress(contents.encode("utf-8")), page_offsets.tobytes()),
+            )
+
+    def get_paths_by_md5(self, md5sum: str) -> list[Path]:
+        rows = self.connection().execute("select path from fileinfo where md5hash = ? order by path", (md5sum,))
+        return [Path(row[0]) for row in rows]
+
+    def get_indexed_content(self, docid: str) -> str | None:
+        row = self.connection().execute("select md5hash from indexinfo where docid = ? limit 1", (docid,)).fetchone()
+        return row[0] if row else None
+
+    def is_path_indexed(self, fpath: Path) -> bool:
+        return self.connection().execute("select 1 from indexinfo where path = ?", (fpath.as_posix(),)).fetchone() is not None
+
+    def is_content_indexed(self, md5sum: str) -> bool:
+        return self.connection().execute("select 1 from indexinfo where md5hash = ? limit 1", (md5sum,)).fetchone() is not None
+
+    def get_duplicate_groups(self, limit: int) -> list[tuple[str, int, list[str]]]:
+        rows = self.connection().execute(
+            "select md5hash, max(size), group_concat(path, char(10)) from fileinfo where md5hash != ''"
+            " group by md5hash having count(*) > 1 order by max(size) * (count(*) - 1) desc limit ?",
+            (limit,),
+        )
+        return [(row[0], row[1], sorted(row[2].split("\n"))) for row in rows]
+
+    def remove_index_entries(self, paths: list[str]):
+        self._executemany_chunked("delete from indexinfo where path = ?", ((path,) for path in paths))
+
+
+class Job:
+    # A scan or analysis run with progress counters, shared between its worker thread and the web handlers
+    COUNTERS = ("discovered", "hashed", "ocred", "indexed", "processed")
+    _ids = itertools.count(1)
+
+    def __init__(self, kind: str, target: str = ""):
+        self.id = f"{kind}-{next(Job._ids)}"
+        self.kind = kind
+        self.target = target
+        self.state = "queued"
+        self.error = ""
+        self.total = 0
+        self.counters = dict.fromkeys(Job.COUNTERS, 0)
+        self.created = time.time()
+        self.started = 0.0
+        self.finished = 0.0
+        self.result: dict[str, object] = {}
+        self._cancel = threading.Event()
+        self._lock = threading.Lock()
+
+    def count(self, counter: str, amount: int = 1):
+        with self._lock:
+            self.counters[counter] += amount
+
+    def add_total(self, amount: int):
+        with self._lock:
+            self.total += amount
+
+    def cancel(self):
+        self._cancel.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    @property
+    def active(self) -> bool:
+        return self.state in ("queued", "running")
+
+    def run(self, func):
+        self.state = "running"
+        self.started = time.monotonic()
+        try:
+            self.result = func(self) or {}
+            self.state = "cancelled" if self.cancelled else "done"
+        except Exception as exc:  # Reported through the job instead of killing the thread silently
+            self.state = "failed"
+            self.error = str(exc)
+            sys.stderr.write(f"Job {self.id} failed: {str(exc)}\n")
+        self.finished = time.monotonic()
+
+    def snapshot(self) -> dict[str, object]:
+        with self._lock:
+            counters = dict(self.counters)
+        elapsed = ((self.finished or time.monotonic()) - self.started) if self.started else 0.0
+        rates = {name: round(value / elapsed, 2) if elapsed > 0 else 0.0 for name, value in counters.items()}
+        eta = None
+        if self.active and self.total > 0 and rates["processed"] > 0:
+            eta = round(max(self.total - counters["processed"], 0) / rates["processed"], 1)
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "target": self.target,
+            "state": self.state,
+            "error": self.error,
+            "total": self.total,
+            "counters": counters,
+            "rates": rates,
+            "elapsed": round(elapsed, 1),
+            "eta": eta,
+            "result": self.result,
+        }
+
+
+class AnalysisQueue:
+    # Pending analysis work, lowest priority first. Files found while the analysis runs (scans, watch
+    # events) and the page ranges of large documents are pushed into the running queue.
+    def __init__(self):
+        self._heap: list[tuple[tuple, int, Path, str, tuple[int, int] | None]] = []
+        self._priorities: dict[Path, tuple] = {}
+        # (path, lastmodified, size) of the file states queued in this run
+        self._queued: set[tuple[Path, int, int]] = set()
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def push(self, priority: tuple, fpath: Path, md5sum: str, lastmodified: int, size: int) -> bool:
+        # Every state of a file is queued once per analysis run, a file modified meanwhile is queued again
+        with self._lock:
+            if (fpath, lastmodified, size) in self._queued:
+                return False
+            self._queued.add((fpath, lastmodified, size))
+            self._priorities[fpath] = priority
+            heapq.heappush(self._heap, (priority, next(self._order), fpath, md5sum, None))
+            return True
+
+    def push_segments(self, fpath: Path, md5sum: str, segments: list[tuple[int, int]], page_count: int):
+        # Each page range competes with its share of the document size
+        with self._lock:
+            *priority, size = self._priorities[fpath]
+            for pages in segments:
+                share = size * (min(pages[1], page_count) - pages[0]) // page_count
+                heapq.heappush(self._heap, ((*priority, share), next(self._order), fpath, md5sum, pages))
+
+    def pop(self) -> tuple[Path, str, tuple[int, int] | None] | None:
+        with self._lock:
+            if not self._heap:
+                return None
+            _, _, fpath, md5sum, pages = heapq.heappop(self._heap)
+            return fpath, md5sum, pages
+
+    def drain(self):
+        while (item := self.pop()) is not None:
+            yield item
+
+    def release(self, fpath: Path):
+        # The file is queued again by the next push of its current state
+        with self._lock:
+            self._queued = {state for state in self._queued if state[0] != fpath}
+
+
+class ExtractionEntry(NamedTuple):
+    # A file or one of its page ranges in an OCR job. Page ranges report to the status and actions of their document.
+    fpath: Path
+    metadata_dir: Path
+    pages: tuple[int, int] | None
+    status: str
+    actions: list[str]
+
+
+# OCR jobs in the workers: their entries, when they were submitted and the fallback options they run with
+PendingJobs = dict[concurrent.futures.Future, tuple[list[ExtractionEntry], float, ExtractionOptions | None]]
+
+
+@dataclasses.dataclass
+class ServiceConfig:
+    # Settings of the service, set from the command line
+    port: int = 5000
+    reset_index: bool = False
+    index_batch_size: int = 100
+    index_max_latency: float = 1.0
+    ocr_workers: int = 0
+    ocr_threads: int = 0
+    extraction_options: ExtractionOptions = dataclasses.field(default_factory=ExtractionOptions)
+    scan_workers: int = 8
+    watch_dirs: list[Path] = dataclasses.field(default_factory=list)
+    reconcile_interval: float = 3600
+    hash_workers: int = 4
+    dedup: bool = False
+    index_granularity: str = "document"
+    chunk_kb: int = 64
+    search_client: str = "async"
+    search_concurrency: int = 32
+    search_cache_size: int = 256
+    search_cache_ttl: float = 30.0
+    governor: ResourceGovernor = dataclasses.field(default_factory=ResourceGovernor)
+    segment_pages: int = 50
+    ocr_timeout: float = 300.0
+    ocr_max_rss_mb: int = 4096
+
+
 class PaperTrailService:
-    def __init__(self, work_dir: Path | str | None, port: int = 5000):
+    def __init__(self, work_dir: Path | str | None, config: ServiceConfig | None = None):
         self.curr_dir = Path(__file__).absolute().parent
         sys.path.insert(1, self.curr_dir.parent.as_posix())
         work_dir = Path(work_dir or (self.curr_dir / "work"))
-        self.port = port
+        self.config = config or ServiceConfig()
         self.work_dir = work_dir
+        self.extraction_options = self.config.extraction_options
+        self.watch_dirs = [Path(wdir).absolute() for wdir in self.config.watch_dirs]
+        self.chunk_size = self.config.chunk_kb * 1024
+        self.async_client: TypesenseSearchClient | None = None
+        self.search_cache = SearchCache(self.config.search_cache_size, self.config.search_cache_ttl)
+        self.governor = self.config.governor
+        self._torch_threads = 0
+        self.analysis_queue: AnalysisQueue | None = None
+        # Paths requested through /scan, analyzed ahead of the backlog until the boost expires
+        self._boosts: dict[Path, float] = {}
+        # Large PDFs whose page ranges are still being extracted
+        self._segments: dict[Path, dict] = {}
+        # Extraction settings of quarantined files in the current analysis
+        self._fallbacks: dict[Path, ExtractionOptions] = {}
+        # Advanced whenever documents are committed to or removed from the index
+        self.index_generation = 0
+        self.ocr_pool: OCRSupervisor | None = None
         self.client: typesense.Client | None = None
+        self.indexer: TypesenseIndexer | None = None
         self.typesense_server: subprocess.Popen[bytes] | None = None
         self.model: doctr.models.predictor.pytorch.OCRPredictor | None = None
         self.server_thread: threading.Thread | None = None
-        self.tasks: dict[str, threading.Thread] = {}
+        self.jobs: dict[str, Job] = {}
+        self.analysis: Job | None = None
         self._stop_requested: threading.Event = threading.Event()
         self.mutex = threading.Lock()
+        self.model_lock = threading.Lock()
         self.server_thread = threading.Thread(target=lambda that: that.start_typesense(), args=[self])
 
         self.work_dir.mkdir(parents=True, exist_ok=True)
         self.db_file = work_dir / "data.sqlite"
-        conn = self._get_sqlite_conn()
-        c = conn.cursor()
-        c.execute("CREATE TABLE IF NOT EXISTS fileinfo (path text PRIMARY KEY, lastmodified INTEGER, size INTEGER, md5hash char(32))")
-        conn.commit()
+        self.db = PaperTrailDatabase(self.db_file)
+        self.db.create_schema()
 
         typesense_binary = shutil.which("typesense-server", path=self.curr_dir) or shutil.which("typesense-server", path=work_dir)
         self.typesense_binary = Path(typesense_binary or "typesense-server")
@@ -70,82 +1740,248 @@ class PaperTrailService:
         self.typesense_work_dir.mkdir(exist_ok=True)
 
     def warm_up_doctr_cache(self):
-        self.model = doctr.models.ocr_predictor(pretrained=True)
+        model = self.get_model()
+        if self.extraction_options.compile_model:
+            # Fills the compile cache so that the service and its workers start with compiled kernels
+            PageBatcher(model, 1, lambda *_: None, lambda *_: None, self.extraction_options.channels_last).add(
+                "warm-up", [numpy.full((1024, 768, 3), 255, dtype=numpy.uint8)]
+            )
 
-    def start_analyze_all(self):
+    def get_model(self) -> doctr.models.predictor.pytorch.OCRPredictor:
+        # Loaded once, by whichever of the background preload and the first OCR job gets here first
+        with self.model_lock:
+            if self.model is None:
+                sys.stdout.write("Initializing OCR Model... \n")
+                self._apply_torch_threads()
+                self.model = create_ocr_predictor(self.extraction_options)
+                sys.stdout.write("OCR Model ready\n")
+            return self.model
+
+    def _preload_model(self):
+        lower_thread_priority(self.governor.nice)
+        if self.config.ocr_workers > 0:
+            # The workers load their own model as soon as they start
+            self._get_ocr_pool()
+        else:
+            self.get_model()
+
+    def _apply_torch_threads(self):
+        threads = self.config.ocr_threads or self.governor.cpu_budget()
+        if threads != self._torch_threads:
+            set_torch_threads(threads)
+            self._torch_threads = threads
+
+    def _worker_threads(self) -> int:
+        return self.config.ocr_threads or max(1, self.governor.cpu_budget() // self.config.ocr_workers)
+
+    MAX_FINISHED_JOBS = 100
+
+    def start_job(self, job: Job, func) -> Job:
         with self.mutex:
-            if "analyze" in self.tasks:
-                return
-            thrd = threading.Thread(target=lambda that: that.analyze_all(), args=[self])
-            self.tasks["analyze"] = thrd
+            finished = [jid for jid, other in self.jobs.items() if not other.active]
+            for jid in finished[: max(len(finished) - self.MAX_FINISHED_JOBS, 0)]:
+                del self.jobs[jid]
+            self.jobs[job.id] = job
+        threading.Thread(target=job.run, args=[func], daemon=True).start()
+        return job
+
+    def start_analyze_all(self) -> Job | None:
+        with self.mutex:
+            # Analysis starts once the index is ready, see start_services
+            if self.indexer is None:
+                return None
+            if self.analysis is not None and self.analysis.active:
+                # Work found since the analysis started joins its queue by priority. analyze_all takes the
+                # analysis down under the mutex once its queue is empty, so nothing is pushed after that.
+                if self.analysis_queue is not None:
+                    self._enqueue_pending(self.analysis_queue, self.analysis)
+                return self.analysis
+            self.analysis = Job("analyze")
+            analysis = self.analysis
+        return self.start_job(analysis, self.analyze_all)
+
+    BOOST_DURATION = 3600.0
+
+    def start_scan(self, scan_dir: Path) -> Job:
+        now = time.time()
+        with self.mutex:
+            self._boosts = {path: expiry for path, expiry in self._boosts.items() if expiry > now}
+            self._boosts[scan_dir] = now + self.BOOST_DURATION
+
+        def run(job: Job) -> dict[str, object]:
+            counts = self.scan(scan_dir, job)
+            if self._leaves_stale_index(counts) and self.client:
+                self.reconcile_index()
+            self.start_analyze_all()
+            return counts
+
+        return self.start_job(Job("scan", scan_dir.as_posix()), run)
+
+    def start_watcher(self):
+        watcher = InotifyWatcher(self.watch_dirs, self.apply_changes, self.start_reconcile_scan)
+        thrd = threading.Thread(target=watcher.run, args=[self._stop_requested], daemon=True)
         thrd.start()
+        thrd = threading.Thread(target=self._reconcile_periodically, daemon=True)
+        thrd.start()
+
+    def _reconcile_periodically(self):
+        # Low priority safety net for events inotify missed (overflows, network filesystems)
+        lower_thread_priority(self.governor.nice)
+        while not self._stop_requested.wait(self.config.reconcile_interval):
+            try:
+                self.reconcile_scan()
+            except Exception as exc:  # Tried again at the next interval
+                sys.stderr.write(f"Reconcile scan failed: {str(exc)}\n")
+
+    def start_reconcile_scan(self):
+        threading.Thread(target=self.reconcile_scan, daemon=True).start()
+
+    def _leaves_stale_index(self, counts: dict[str, int]) -> bool:
+        # Modified files move to another duplicate group in dedup mode
+        return counts["deleted"] > 0 or (self.config.dedup and counts["modified"] > 0)
+
+    def reconcile_scan(self):
+        stale = False
+        for wdir in self.watch_dirs:
+            stale = self._leaves_stale_index(self.scan(wdir)) or stale
+        if stale:
+            self.reconcile_index()
+        self.start_analyze_all()
+
+    def apply_changes(self, paths: list[Path]):
+        new_files: list[tuple] = []
+        modified: list[tuple] = []
+        deleted = 0
+        stale = False
+        for fpath in paths:
+            if fpath.is_dir():
+                stale = self._leaves_stale_index(self.scan(fpath)) or stale
+                continue
+            try:
+                fstat = fpath.stat() if fpath.is_file() else None
+            except FileNotFoundError:
+                fstat = None
+            if fstat is None:
+                # Either a file or a whole directory went away
+                gone = [fpath.as_posix(), *self.db.get_files_under(fpath.as_posix()).keys()]
+                self.db.remove_files(gone)
+                deleted += len(gone)
+                continue
+            row = self.db.get_file(fpath)
+            if row is None:
+                sys.stdout.write(f"Adding file: {fpath.as_posix()}\n")
+                new_files.append((fpath.as_posix(), fstat.st_mtime, fstat.st_size, fstat.st_dev, fstat.st_ino))
+            elif row[1] != fstat.st_mtime or row[2] != fstat.st_size:
+                modified.append((fstat.st_mtime, fstat.st_size, fstat.st_dev, fstat.st_ino, fpath.as_posix()))
+        self.db.add_files(new_files)
+        self.db.update_modified_files(modified)
+        if (stale or self._leaves_stale_index({"deleted": deleted, "modified": len(modified)})) and self.client:
+            self.reconcile_index()
+        self.start_analyze_all()
 
     def start_typesense(self):
-        shutil.rmtree(self.typesense_work_dir.as_posix())
-        self.typesense_work_dir.mkdir(exist_ok=True)
         while not self._stop_requested.is_set():
             sys.stdout.write("Starting Typesense Service ... \n")
             self.typesense_server = subprocess.check_call(
                 [
                     self.typesense_binary.as_posix(),
                     f"--data-dir={self.typesense_work_dir.as_posix()}",
-                    "--api-key=test",
+                    f"--api-key={TYPESENSE_API_KEY}",
                     f"--log-dir={self.typesense_work_dir.as_posix()}",
                 ]
             )
 
-    def start(self):
-        self.server_thread.start()
-        wait_time_in_seconds = 10
-        granularity = 100
-        port = 8108
-        for i in range(granularity):
-            time.sleep(wait_time_in_seconds / granularity)
-            soc = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    def wait_for_typesense(self, port: int, timeout: float = 300):
+        # typesense answers /health with ok only once its collections are loaded
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and not self._stop_requested.is_set():
             try:
-                soc.connect(("localhost", port))
-                soc.shutdown(2)
-                break
-            except ConnectionRefusedError as exc:
-                if i == granularity:
-                    raise TypesenseBridgeException("Cannot start typesense-server") from exc
+                with urllib.request.urlopen(f"http://localhost:{port}/health", timeout=1) as response:
+                    if json.loads(response.read()).get("ok", False):
+                        return
+            except (urllib.error.URLError, OSError, ValueError):
+                pass
+            time.sleep(0.1)
+        raise TypesenseBridgeException("Cannot start typesense-server")
 
-        self.client = typesense.Client(
-            {"api_key": "test", "nodes": [{"host": "localhost", "port": f"{port}", "protocol": "http"}], "connection_timeout_seconds": 2}
-        )
+    STARTUP_RETRY_INTERVAL = 10.0
 
-        # Drop pre-existing collection if any
+    def start_services(self, scan_dirs: list[Path], port: int):
+        # Everything the web server does not need to answer runs here, in order of what search needs first
+        for sdir in scan_dirs:
+            try:
+                self.scan(Path(sdir))
+            except Exception as exc:  # Picked up by a later scan
+                sys.stderr.write(f"Cannot scan {Path(sdir).as_posix()}: {str(exc)}\n")
         try:
-            self.client.collections["documents"].delete()
-        except typesense.exceptions.TypesenseClientError:
-            pass
+            self.wait_for_typesense(port)
+        except TypesenseBridgeException as exc:
+            sys.stderr.write(f"{str(exc)}\n")
+            return
+        self.client = self._make_client(port, 2)
+        if self.config.search_client == "async":
+            self.async_client = TypesenseSearchClient(port, TYPESENSE_API_KEY, max_concurrency=self.config.search_concurrency)
+        while not self._stop_requested.is_set():
+            try:
+                self._prepare_index(port)
+                break
+            except Exception as exc:  # Analysis waits for the index, it is tried again
+                sys.stderr.write(f"Cannot prepare the index: {str(exc)}\n")
+                self._stop_requested.wait(self.STARTUP_RETRY_INTERVAL)
+        if self._stop_requested.is_set():
+            return
+        threading.Thread(target=self._preload_model, daemon=True).start()
+        self.start_analyze_all()
+        threading.Thread(target=self._retry_periodically, daemon=True).start()
+        if self.watch_dirs:
+            self.start_watcher()
 
-        self.client.collections.create(
-            {
-                "name": "documents",
-                "fields": [
-                    {"name": "filename", "type": "string", "infix": True},
-                    {"name": "url", "type": "string"},
-                    {"name": "tags", "type": "string[]", "facet": True},
-                    {"name": "created_at", "type": "int32"},
-                    {"name": "contents", "type": "string"},
-                ],
-                "default_sorting_field": "created_at",
-            }
-        )
+    def _prepare_index(self, port: int):
+        self._ensure_collection()
+        if self.indexer is None:
+            # Bulk imports carry many documents per request and need a more generous timeout
+            self.indexer = TypesenseIndexer(
+                self._make_client(port, 60),
+                self._on_indexed,
+                batch_size=self.config.index_batch_size,
+                max_latency=self.config.index_max_latency,
+                on_failed=self._on_index_failed,
+            )
+        self.reconcile_index()
 
-        sys.stdout.write("Initializing OCR Model... \n")
-        self.model = doctr.models.ocr_predictor(pretrained=True)
+    def _retry_periodically(self):
+        # Failed stages come back into get_pending_files once their backoff expired
+        while not self._stop_requested.wait(60):
+            next_retry = self.db.get_next_retry()
+            if next_retry is not None and next_retry <= time.time():
+                self.start_analyze_all()
+
+    def start(self, scan_dirs: list[Path] | None = None):
+        self.server_thread.start()
+        port = 8108
         sys.stdout.write("Initializing Web Service... \n")
         app = aiohttp.web.Application()
+        app.on_cleanup.append(self._close_async_client)
+        app.cleanup_ctx.append(self._monitor_loop_lag)
         app.add_routes([aiohttp.web.get(r"/app/{filepath:.*}", self.websvc_app)])
         app.add_routes([aiohttp.web.get("/", self.websvc_main)])
         app.add_routes([aiohttp.web.get(r"/files/{filepath:.*}", self.websvc_files)])
         app.add_routes([aiohttp.web.get(r"/scan/{filepath:.*}", self.websvc_scan)])
         app.add_routes([aiohttp.web.get("/search", self.websvc_search)])
-        self.start_analyze_all()
+        app.add_routes([aiohttp.web.get("/duplicates", self.websvc_duplicates)])
+        app.add_routes([aiohttp.web.get("/document/{docid}/text", self.websvc_document_text)])
+        app.add_routes([aiohttp.web.get("/pipeline", self.websvc_pipeline)])
+        app.add_routes([aiohttp.web.get("/governor", self.websvc_governor)])
+        app.add_routes([aiohttp.web.post("/governor", self.websvc_set_governor)])
+        app.add_routes([aiohttp.web.get("/jobs", self.websvc_jobs)])
+        app.add_routes([aiohttp.web.get("/jobs/{jobid}", self.websvc_job)])
+        app.add_routes([aiohttp.web.delete("/jobs/{jobid}", self.websvc_cancel_job)])
+        app.add_routes([aiohttp.web.get("/jobs/{jobid}/events", self.websvc_job_events)])
+        # The web server comes up right away, search becomes available once typesense is ready
+        threading.Thread(target=self.start_services, args=[scan_dirs or [], port], daemon=True).start()
         # logging.basicConfig(level=logging.DEBUG, filename=str(self.rundir / f"opendirdiff_log_{os.getpid()}.log"))
-        aiohttp.web.run_app(app, port=self.port)
+        # Handlers of requests that the browser aborted are cancelled together with their searches
+        aiohttp.web.run_app(app, port=self.config.port, handler_cancellation=True)
 
     async def websvc_app(self, request: aiohttp.web.Request) -> aiohttp.web.FileResponse:
         filepath = request.match_info.get("filepath", "")
@@ -165,22 +2001,204 @@ class PaperTrailService:
 
     async def websvc_scan(self, request: aiohttp.web.Request) -> aiohttp.web.Response:
         abspath = Path("/") / Path(request.match_info["filepath"])
+        job = self.start_scan(abspath)
+        return aiohttp.web.json_response(job.snapshot(), status=202)
+
+    def _get_job(self, request: aiohttp.web.Request) -> Job:
+        job = self.jobs.get(request.match_info["jobid"])
+        if job is None:
+            raise TypesenseBridgeException(f"Cannot find job {request.match_info['jobid']}")
+        return job
+
+    async def _monitor_loop_lag(self, _app: aiohttp.web.Application):
+        async def monitor():
+            interval = 0.25
+            while True:
+                start = time.monotonic()
+                await asyncio.sleep(interval)
+                self.governor.note_loop_lag(max(0.0, time.monotonic() - start - interval))
+
+        task = asyncio.ensure_future(monitor())
+        yield
+        task.cancel()
+
+    async def websvc_governor(self, _request: aiohttp.web.Request) -> aiohttp.web.Response:
+        return aiohttp.web.json_response(self.governor.snapshot())
+
+    async def websvc_set_governor(self, request: aiohttp.web.Request) -> aiohttp.web.Response:
+        mode = request.query.get("mode", "")
+        if mode not in ResourceGovernor.MODES:
+            raise TypesenseBridgeException(f"Unknown governor mode {mode}")
+        self.governor.mode = mode
+        sys.stdout.write(f"Governor switched to {mode} mode\n")
+        return aiohttp.web.json_response(self.governor.snapshot())
+
+    async def websvc_pipeline(self, request: aiohttp.web.Request) -> aiohttp.web.Response:
+        limit = clamp_int(request.query.get("limit"), 50, 1, 1000)
         loop = asyncio.get_running_loop()
-        await loop.run_in_executor(None, lambda: self.scan(abspath))
-        self.start_analyze_all()
-        return aiohttp.web.Response(text=abspath.as_posix())
+        return aiohttp.web.json_response(await loop.run_in_executor(None, lambda: self.db.get_pipeline_summary(limit)))
+
+    async def websvc_jobs(self, _request: aiohttp.web.Request) -> aiohttp.web.Response:
+        return aiohttp.web.json_response([job.snapshot() for job in list(self.jobs.values())])
+
+    async def websvc_job(self, request: aiohttp.web.Request) -> aiohttp.web.Response:
+        return aiohttp.web.json_response(self._get_job(request).snapshot())
+
+    async def websvc_cancel_job(self, request: aiohttp.web.Request) -> aiohttp.web.Response:
+        job = self._get_job(request)
+        job.cancel()
+        return aiohttp.web.json_response(job.snapshot())
+
+    async def websvc_job_events(self, request: aiohttp.web.Request) -> aiohttp.web.StreamResponse:
+        # Server-sent events with a job snapshot every second until the job ends
+        job = self._get_job(request)
+        response = aiohttp.web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+        while True:
+            active = job.active
+            await response.write(f"event: progress\ndata: {json.dumps(job.snapshot())}\n\n".encode("utf-8"))
+            if not active:
+                break
+            await asyncio.sleep(1)
+        return response
 
     async def websvc_search(self, request: aiohttp.web.Request) -> aiohttp.web.Response:
         if not self.client:
             raise TypesenseBridgeException("typesense client unavailable")
-        loop = asyncio.get_running_loop()
-        search_query = dict(request.query)
-        search_query.setdefault("query_by", "filename,contents")
-        search_query.setdefault("infix", "always,off")
+        search_query = {key: value for key, value in request.query.items() if key in SEARCH_PARAMETERS}
         if "q" not in search_query:
             raise TypesenseBridgeException("empty query")
-        result = await loop.run_in_executor(None, lambda: self.client.collections["documents"].documents.search(search_query))
-        return aiohttp.web.json_response(result)
+        search_query["q"] = " ".join(search_query["q"].lower().split())
+        self.governor.note_search()
+        search_query.update(
+            {
+                "query_by": "filename,contents",
+                "infix": "always,off",
+                "exclude_fields": "contents",
+                "highlight_fields": "contents",
+                "highlight_affix_num_tokens": SNIPPET_TOKENS,
+                "page": clamp_int(search_query.get("page"), 1, 1, SEARCH_MAX_PAGE),
+                "per_page": clamp_int(search_query.get("per_page"), SEARCH_PER_PAGE, 1, SEARCH_MAX_PER_PAGE),
+            }
+        )
+        if self.config.index_granularity != "document":
+            # Hits are pages or chunks, show the best ones of each file together
+            search_query.update({"group_by": "parent_id", "group_limit": 3})
+        key = json.dumps([self.index_generation, search_query], sort_keys=True)
+        body = await self.search_cache.get(key, lambda: self._search(search_query))
+        return aiohttp.web.Response(body=body, content_type="application/json")
+
+    async def _search(self, search_query: dict[str, object]) -> bytes:
+        if self.async_client:
+            result = await self.async_client.search(search_query)
+        else:
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(None, lambda: self.client.collections["documents"].documents.search(search_query))
+        return json.dumps(compact_search_result(result)).encode("utf-8")
+
+    def _on_indexed(self, tokens: list[tuple[Path, str, int, int, str]]):
+        self.db.mark_indexed(tokens)
+        version = self._schema_marker()
+        self.db.record_stages([(fpath.as_posix(), "index", version, "done", md5sum, 0.0, "") for fpath, _, _, _, md5sum in tokens])
+        self._count("indexed", len(tokens))
+        self.index_generation += 1
+
+    def _on_index_failed(self, tokens: list[tuple[Path, str, int, int, str]], error: str):
+        version = self._schema_marker()
+        self.db.record_stages([(fpath.as_posix(), "index", version, "failed", md5sum, 0.0, error) for fpath, _, _, _, md5sum in tokens])
+
+    async def _close_async_client(self, _app: aiohttp.web.Application):
+        if self.async_client:
+            await self.async_client.close()
+
+    async def websvc_document_text(self, request: aiohttp.web.Request) -> aiohttp.web.Response:
+        docid = request.match_info["docid"]
+        loop = asyncio.get_running_loop()
+        md5sum = await loop.run_in_executor(None, lambda: self.db.get_indexed_content(docid))
+        if md5sum is None:
+            raise TypesenseBridgeException(f"Cannot find document {docid}")
+        contents, page_offsets = await loop.run_in_executor(None, lambda: self._load_text(self.work_dir / md5sum))
+        pages = max(len(page_offsets), 1)
+        if "page" not in request.query:
+            return aiohttp.web.json_response({"id": docid, "pages": pages, "text": contents})
+        page = clamp_int(request.query["page"], 0, 0, pages - 1)
+        response = {"id": docid, "pages": pages, "page": page, "text": page_text(contents, page_offsets, page)}
+        if "words" in request.query:
+            # Word boxes for highlights, offsets are relative to the page text and boxes are relative to the page size
+            boxes = await loop.run_in_executor(None, lambda: load_word_boxes(self.work_dir / md5sum, page))
+            base = page_offsets[page] if page_offsets else 0
+            response["words"] = [
+                {"start": start - base, "end": end - base, "box": None if math.isnan(box[0]) else [round(value, 4) for value in box]}
+                for start, end, box in boxes
+            ]
+        return aiohttp.web.json_response(response)
+
+    def _make_client(self, port: int, timeout: int) -> typesense.Client:
+        return typesense.Client(
+            {
+                "api_key": TYPESENSE_API_KEY,
+                "nodes": [{"host": "localhost", "port": f"{port}", "protocol": "http"}],
+                "connection_timeout_seconds": timeout,
+            }
+        )
+
+    def _schema_marker(self) -> str:
+        schema_hash = hashlib.sha1(
+            json.dumps(documents_schema(self.config.dedup, self.config.index_granularity), sort_keys=True).encode("utf-8")
+        ).hexdigest()
+        return f"{INDEX_SCHEMA_VERSION}:{schema_hash[:12]}"
+
+    def _ensure_collection(self):
+        collection = self.client.collections["documents"]
+        marker = self._schema_marker()
+        try:
+            collection.retrieve()
+            exists = True
+        except typesense.exceptions.ObjectNotFound:
+            exists = False
+        if exists and (self.config.reset_index or self.db.get_setting("index_schema") != marker):
+            sys.stdout.write("Dropping outdated typesense collection ... \n")
+            collection.delete()
+            exists = False
+        if not exists:
+            self.client.collections.create(documents_schema(self.config.dedup, self.config.index_granularity))
+            self.db.clear_index()
+            self.db.set_setting("index_schema", marker)
+
+    def reconcile_index(self):
+        # In dedup mode a path that changed content also leaves its old group
+        stale = self.db.get_stale_index_entries(self.config.dedup)
+        self.db.remove_index_entries([path for path, _ in stale])
+        for docid in {docid for _, docid in stale}:
+            if self.config.dedup:
+                self._update_duplicate_group(docid)
+            else:
+                self._delete_document(docid)
+        if self.indexer:
+            self.indexer.flush()
+        pending = len(self.db.get_pending_files())
+        sys.stdout.write(f"Index reconciled: {len(stale)} removed, {pending} pending\n")
+
+    def _delete_document(self, docid: str):
+        self.index_generation += 1
+        documents = self.client.collections["documents"].documents
+        if self.config.index_granularity != "document":
+            documents.delete({"filter_by": f"parent_id:={docid}"})
+            return
+        try:
+            documents[docid].delete()
+        except typesense.exceptions.ObjectNotFound:
+            pass
+
+    async def websvc_duplicates(self, request: aiohttp.web.Request) -> aiohttp.web.Response:
+        limit = clamp_int(request.query.get("limit"), 100, 1, 1000)
+        loop = asyncio.get_running_loop()
+        groups = await loop.run_in_executor(None, lambda: self.db.get_duplicate_groups(limit))
+        report = [
+            {"md5": md5sum, "size": size, "count": len(paths), "wasted_bytes": size * (len(paths) - 1), "paths": paths}
+            for md5sum, size, paths in groups
+        ]
+        return aiohttp.web.json_response({"groups": report, "wasted_bytes": sum(group["wasted_bytes"] for group in report)})
 
     def _detect_path(self, relpath: Path):
         for base in (self.curr_dir, self.work_dir):
@@ -199,91 +2217,117 @@ class PaperTrailService:
     def wait_for_stop(self):
         pass
 
-    def scan(self, scan_dir: Path):
-        files: Path = []
-        for fpath in scan_dir.rglob("*"):
-            if fpath.is_file():
-                files.append(fpath.absolute())
-        self._verify_or_add_entry(files)
-
-    def get_all_files(self) -> dict[Path, str]:
-        conn = self._get_sqlite_conn()
-        c = conn.cursor()
-        c.execute("select path,md5hash from fileinfo")
-        return {Path(row[0]): row[1] for row in c.fetchall()}
-
-    def _verify_or_add_entry(self, files: list[Path]):
-        known_files = self.get_all_files()
-        for fpath in files:
-            if fpath in known_files:
-                continue
-            sys.stdout.write(f"Adding file: {fpath.as_posix()}\n")
-            fstat = fpath.stat()
-            mtime = fstat.st_mtime
-            size = fstat.st_size
-            conn = self._get_sqlite_conn()
-            c = conn.cursor()
-            c.execute("insert into fileinfo values(?,?,?,?)", (fpath.as_posix(), mtime, size, ""))
-            conn.commit()
+    def scan(self, scan_dir: Path, job: Job | None = None):
+        root = Path(scan_dir).absolute().as_posix()
+        known = self.db.get_files_under(root)
+        new_files: list[tuple] = []
+        modified: list[tuple] = []
+        file_ids: list[tuple] = []
+        counts = {"new": 0, "modified": 0, "deleted": 0}
+        failed: list[str] = []
+
+        def flush():
+            self.db.add_files(new_files)
+            self.db.update_modified_files(modified)
+            self.db.update_file_ids(file_ids)
+            counts["new"] += len(new_files)
+            counts["modified"] += len(modified)
+            new_files.clear()
+            modified.clear()
+            file_ids.clear()
+
+        for entries in scan_tree(root, self.config.scan_workers, failed):
+            if job:
+                job.count("discovered", len(entries))
+                if job.cancelled:
+                    # A partial walk cannot tell deleted files apart from unvisited ones
+                    flush()
+                    return {**counts, "deleted": 0}
+            for path, device, inode, size, mtime in entries:
+                row = known.pop(path, None)
+                if row is None:
+                    sys.stdout.write(f"Adding file: {path}\n")
+                    new_files.append((path, mtime, size, device, inode))
+                elif row[0] != mtime or row[1] != size:
+                    modified.append((mtime, size, device, inode, path))
+                elif row[2] != device or row[3] != inode:
+                    file_ids.append((device, inode, path))
+            if len(new_files) + len(modified) + len(file_ids) >= self.db.batch_size:
+                flush()
+        flush()
+        if root in failed:
+            sys.stdout.write(f"Scanned {root}: cannot read the root, nothing deleted\n")
+            return counts
+        # Whatever was known under the root but not seen during the walk is gone,
+        # except below directories that could not be read
+        unreadable = set(failed)
+        prefixes = tuple(path.rstrip("/") + "/" for path in unreadable)
+        deleted = [path for path in known if path not in unreadable and not path.startswith(prefixes)]
+        self.db.remove_files(deleted)
+        counts["deleted"] = len(deleted)
+        sys.stdout.write(f"Scanned {root}: {counts['new']} new, {counts['modified']} modified, {counts['deleted']} deleted\n")
+        return counts
 
     def verify(self, fpath: Path):
-        conn = self._get_sqlite_conn()
-        c = conn.cursor()
         if not fpath.exists():
-            c.execute("delete from fileinfo where path = ?", (fpath.as_posix(),))
+            self.db.remove_file(fpath)
             return True
         fstat = fpath.stat()
         mtime = fstat.st_mtime
         size = fstat.st_size
-        update = False
-        found = False
-        for row in c.execute("select * from fileinfo WHERE path=?", (fpath.as_posix(),)):
-            found = True
-            update = row[1] != mtime or row[2] != size
-        if update:
-            c.execute("update fileinfo set lastmodified = ?, size = ?, md5hash = ? where path = ? ", (mtime, size, "", fpath.as_posix()))
-        return found
-
-    def _get_sqlite_conn(self):
-        for i in range(10):
-            try:
-                return sqlite3.connect(self.db_file.as_posix(), detect_types=sqlite3.PARSE_DECLTYPES)
-            except sqlite3.Error:
-                sys.stderr.write(f"Cannot open sqlite. Attempt {i}. Retrying in 5s")
-                time.sleep(5)
-        raise TypesenseBridgeException("Cannot open sqlite")
+        row = self.db.get_file(fpath)
+        if row is not None and (row[1] != mtime or row[2] != size):
+            self.db.update_file(fpath, mtime, size, "")
+        return row is not None
 
-    # Dir
-    #   file0
-    #   page0_ocr_doctr.json
-    #   page1_thumbnail.jpg
-    #   page2_pdf2text.json
-    #   page3_ocr_tesseract.json
-    #   page4_tags.json
-    #   tags.json
-    def analyze_file(self, fpath: Path, md5sum: str, status: str) -> bool:
-        sys.stderr.write(f"{status} Analyzing {fpath.as_posix()}\n")
-        actions: dict[str, str] = {}
-        changed = False
-        actions: list[str] = []
-        if len(md5sum) == 0:
-            hash_md5 = hashlib.md5()
-            with fpath.open("rb") as f:
-                for chunk in iter(lambda: f.read(4096), b""):
-                    hash_md5.update(chunk)
-            md5sum = hash_md5.hexdigest()
-            fstat = fpath.stat()
-            mtime = fstat.st_mtime
-            size = fstat.st_size
-
-            conn = self._get_sqlite_conn()
-            c = conn.cursor()
-            c.execute("update fileinfo set lastmodified = ?, size = ?, md5hash = ? where path = ?", (mtime, size, md5sum, fpath.as_posix()))
-            c.close()
-            conn.commit()
-            actions.append(f"md5sum={md5sum}")
-            changed = True
+    def _hash_files(self, to_analyze):
+        # Hashes run on their own thread pool ahead of the OCR stage. Files whose
+        # (device, inode, size, mtime) fingerprint is known reuse the stored md5.
+        # Items are (path, md5hash, page range), page ranges of hashed files pass straight through.
+        window: collections.deque = collections.deque()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.config.hash_workers) as pool:
+            for fpath, md5sum, pages in to_analyze:
+                if len(md5sum) > 0:
+                    window.append((fpath, pages, None, None, md5sum))
+                else:
+                    try:
+                        fstat = fpath.stat()
+                    except OSError as exc:
+                        sys.stderr.write(f"Cannot Analyze {str(fpath)}: {str(exc)}\n")
+                        self._record_stage(fpath, "hash", error=str(exc))
+                        continue
+                    known = self.db.find_fingerprint(fstat.st_dev, fstat.st_ino, fstat.st_size, fstat.st_mtime)
+                    future = None if known else pool.submit(timed_hash_file, fpath)
+                    window.append((fpath, pages, fstat, future, known))
+                while len(window) > 4 * self.config.hash_workers:
+                    yield self._hash_result(*window.popleft())
+            while window:
+                yield self._hash_result(*window.popleft())
+
+    def _hash_result(
+        self,
+        fpath: Path,
+        pages: tuple[int, int] | None,
+        fstat: os.stat_result | None,
+        future: concurrent.futures.Future | None,
+        md5sum: str | None,
+    ):
+        if fstat is None:
+            return fpath, md5sum, [], pages
+        duration = 0.0
+        try:
+            if future is not None:
+                md5sum, duration = future.result()
+        except OSError as exc:
+            sys.stderr.write(f"Cannot Analyze {str(fpath)}: {str(exc)}\n")
+            self._record_stage(fpath, "hash", error=str(exc))
+            return fpath, None, [], pages
+        self.db.record_hash(fpath, fstat, md5sum)
+        self._record_stage(fpath, "hash", md5sum, duration)
+        return fpath, md5sum, [f"md5sum={md5sum}" if future is not None else f"md5sum={md5sum}(fingerprint)"], pages
 
+    def _prepare_file(self, fpath: Path, md5sum: str) -> tuple[Path, list[str]]:
+        actions: list[str] = []
         metadata_dir = self.work_dir / md5sum
         metadata_dir.mkdir(parents=True, exist_ok=True)
         symlink = metadata_dir / "file"
@@ -291,131 +2335,652 @@ class PaperTrailService:
             symlink.unlink(missing_ok=True)
             os.symlink(fpath, symlink.as_posix())
             actions.append(f"symlink={symlink.as_posix()}")
-            changed = True
+        return metadata_dir, actions
 
-        if len(list(metadata_dir.glob("*.textdata.json"))) == 0:
-            try:
-                doc = None
-                if fpath.suffix.lower() in (".jpg", ".png"):
-                    doc = doctr.io.DocumentFile.from_images(fpath.as_posix())
-                    (metadata_dir / "ocr.textdata.json").write_text(json.dumps(self.model(doc).export()))
-                    actions.append("ocr.textdata.json")
-                    changed = True
-
-                if fpath.suffix.lower() in (".pdf"):
-                    doc = doctr.io.DocumentFile.from_pdf(fpath.as_posix())
-                    (metadata_dir / "ocr.textdata.json").write_text(json.dumps(self.model(doc).export()))
-                    actions.append("ocr.textdata.json")
-                    changed = True
-
-                if fpath.suffix.lower() in (".pdf"):
-                    pages = []
-                    for page in pypdfium2.PdfDocument(fpath.as_posix()):
-                        textpage = page.get_textpage()
-                        lines: list = []
-
-                        for rect_index in range(textpage.count_rects()):
-                            rect = textpage.get_rect(rect_index)
-                            text = textpage.get_text_bounded(*rect)
-                            if len(text) == 0:
-                                continue
-                            lines.append({"words": [{"value": text, "geometry": rect}]})
-                        if len(lines) > 0:
-                            pages.append({"blocks": [{"lines": lines}]})
-
-                    if False:
-                        reader = PyPDF2.PdfReader(fpath.as_posix())
-                        lines = []
-                        pages = []
-
-                        def visitor_text(text, cm, tm, fontDict, fontSize):
-                            if len(text) == 0:
-                                return
-                            lines.append({"words": [{"value": text, "geometry": []}]})
-                            print(f"{tm}:{text}")
-
-                        for page in reader.pages:
-                            page.extract_text(visitor_text=visitor_text)
-                            pages.append({"blocks": [{"lines": lines}]})
-                    jsondata = {"pages": pages}
-                    (metadata_dir / "pdftext.textdata.json").write_text(json.dumps(jsondata))
-                    actions.append("pdftext.textdata.json")
-                    changed = True
-
-            except (pypdfium2.PdfiumError, OSError) as exc:
-                sys.stderr.write(f"Error Processing PDF: {str(exc)}\n")
-                pass
+    def _load_text(self, metadata_dir: Path) -> tuple[str, array.array]:
+        # Textdata json is decoded once per content, later indexing reads the stored plain text
+        sources = textdata_sources(metadata_dir)
+        stored = self.db.get_text(metadata_dir.name)
+        if stored is not None and stored[0] == sources:
+            return stored[1], stored[2]
+        contents, page_offsets = build_text_store(metadata_dir)
+        self.db.put_text(metadata_dir.name, sources, contents, page_offsets)
+        return contents, page_offsets
 
-        contents = ""
-        for text_data in metadata_dir.glob("*.textdata.json"):
-            json_doc = json.loads(text_data.read_text())
-            blocks: list[str] = []
-            for page in json_doc["pages"]:
-                for block in page["blocks"]:
-                    lines: list[str] = []
-                    for line in block["lines"]:
-                        words: list[str] = []
-                        for word in line["words"]:
-                            words.append(word["value"])
-                        lines.append(" ".join(words))
-                    blocks.append("\n".join(lines))
-            contents = "\n\n".join(blocks)
+    def _index_tokens(self, paths: list[Path], docid: str, md5sum: str) -> list[tuple[Path, str, int, int, str]]:
+        # The indexed state is taken when the document is queued, a file that changes
+        # before the import completes stays pending
+        tokens = []
+        for path in paths:
+            row = self.db.get_file(path)
+            tokens.append((path, docid, row[1] if row else 0, row[2] if row else 0, md5sum))
+        return tokens
 
+    def _index_file(self, fpath: Path, metadata_dir: Path):
+        contents, page_offsets = self._load_text(metadata_dir)
+        docid = document_id(fpath)
         typesense_dict: dict[str, object] = {
+            "id": docid,
             "filename": fpath.name,
-            "url": (Path("/files") / fpath.relative_to(Path("/"))).as_posix(),
+            "url": file_url(fpath),
             "tags": [],
             "created_at": 0,
             "contents": contents,
         }
-        if self.client:
-            self.client.collections["documents"].documents.create(typesense_dict)
+        tokens = self._index_tokens([fpath], docid, metadata_dir.name)
+        if self.config.dedup:
+            docid = metadata_dir.name
+            paths = self.db.get_paths_by_md5(docid) or [fpath]
+            typesense_dict.update({"id": docid, "paths": [path.as_posix() for path in paths], "urls": [file_url(path) for path in paths]})
+            tokens = self._index_tokens(paths, docid, docid)
+        if not self.indexer:
+            return
+        if self.config.index_granularity == "document":
+            self.indexer.add(typesense_dict, tokens)
+            return
+        if not self.config.dedup and self.db.is_path_indexed(fpath):
+            # A changed file may now have fewer pieces than before
+            try:
+                self._delete_document(docid)
+            except (typesense.exceptions.TypesenseClientError, OSError) as exc:
+                # Importing over the old pieces would leave the surplus ones behind, the retry starts over
+                sys.stderr.write(f"Cannot delete the pieces of {fpath.as_posix()}: {str(exc)}\n")
+                self._record_stage(fpath, "index", metadata_dir.name, error=str(exc))
+                return
+        pieces = split_pieces(contents, page_offsets, self.config.index_granularity, self.chunk_size)
+        for index, (page, text) in enumerate(pieces):
+            piece = {**typesense_dict, "id": f"{docid}-{index}", "parent_id": docid, "page": page, "contents": text}
+            piece["url"] = f"{typesense_dict['url']}#page={page + 1}"
+            # The file counts as indexed once its last piece is in
+            self.indexer.add(piece, tokens if index == len(pieces) - 1 else [])
+
+    def _piece_ids(self, md5sum: str) -> list[str]:
+        if self.config.index_granularity == "document":
+            return [md5sum]
+        contents, page_offsets = self._load_text(self.work_dir / md5sum)
+        return [
+            f"{md5sum}-{index}"
+            for index in range(len(split_pieces(contents, page_offsets, self.config.index_granularity, self.chunk_size)))
+        ]
+
+    def _update_duplicate_group(self, md5sum: str):
+        paths = self.db.get_paths_by_md5(md5sum)
+        if not paths:
+            self._delete_document(md5sum)
+            return
+        update = {
+            "filename": paths[0].name,
+            "paths": [path.as_posix() for path in paths],
+            "urls": [file_url(path) for path in paths],
+        }
+        if self.config.index_granularity == "document":
+            update["url"] = file_url(paths[0])
+        if not self.indexer:
+            return
+        piece_ids = self._piece_ids(md5sum)
+        group_tokens = self._index_tokens(paths, md5sum, md5sum)
+        for index, piece_id in enumerate(piece_ids):
+            tokens = group_tokens if index == len(piece_ids) - 1 else []
+            self.indexer.add({**update, "id": piece_id}, tokens, action="update")
+
+    # Dir
+    #   file0
+    #   page0_ocr_doctr.json
+    #   page1_thumbnail.jpg
+    #   page2_pdf2text.json
+    #   page3_ocr_tesseract.json
+    #   page4_tags.json
+    #   tags.json
+    def analyze_file(self, fpath: Path, md5sum: str, status: str) -> bool:
+        sys.stderr.write(f"{status} Analyzing {fpath.as_posix()}\n")
+        _, md5sum, actions, _ = next(self._hash_files([(fpath, md5sum, None)]))
+        if md5sum is None:
+            return False
+        metadata_dir, prepare_actions = self._prepare_file(fpath, md5sum)
+        actions += prepare_actions
+        if fpath.suffix.lower() in EXTRACTABLE_SUFFIXES and needs_text_extraction(metadata_dir):
+            actions += extract_texts(self.get_model(), [(fpath.as_posix(), metadata_dir.as_posix(), None)], self.extraction_options)[
+                fpath.as_posix()
+            ]
+        self._index_file(fpath, metadata_dir)
         actiontext = "\t".join(actions)
         sys.stderr.write(f"{status} \t {actiontext}\n")
-        return changed
-
-    def analyze_all(self):
-        keep_going = True
-        analyzed: set[Path] = set()
-        while keep_going:
-            keep_going = False
-            known_files = self.get_all_files()
-            to_analyze = set(known_files.keys()) - analyzed
-            count = 0
-            total = len(to_analyze)
-            analyzed  = analyzed | to_analyze
-            for fpath in to_analyze:
-                keep_going = True
-                md5sum = known_files[fpath]
+        return len(actions) > 0
+
+    def _get_ocr_pool(self) -> OCRSupervisor:
+        with self.model_lock:
+            if self.ocr_pool is None:
+                sys.stdout.write(f"Starting {self.config.ocr_workers} OCR workers ... \n")
+                self.ocr_pool = OCRSupervisor(
+                    self.config.ocr_workers,
+                    (self._worker_threads(), self.extraction_options, self.governor.nice),
+                    self.config.ocr_timeout,
+                    self.config.ocr_max_rss_mb << 20,
+                )
+            return self.ocr_pool
+
+    def _count(self, counter: str, amount: int = 1):
+        if self.analysis is not None:
+            self.analysis.count(counter, amount)
+
+    def _stage_versions(self) -> dict[str, str]:
+        return {"hash": HASH_VERSION, "extract": self.extraction_options.version(), "index": self._schema_marker()}
+
+    def _record_stage(self, fpath: Path, stage: str, md5sum: str | None = None, duration: float = 0.0, error: str | None = None):
+        # A stage recorded with an error failed
+        state = "done" if error is None else "failed"
+        self.db.record_stages([(fpath.as_posix(), stage, self._stage_versions()[stage], state, md5sum, duration, error or "")])
+
+    def _extraction_current(self, metadata_dir: Path) -> bool:
+        # Contents extracted before the ledger existed are taken as current
+        stage = self.db.get_content_stage(metadata_dir.name, "extract")
+        return not needs_text_extraction(metadata_dir) and (stage is None or stage == (self.extraction_options.version(), "done"))
+
+    def _needs_extraction(self, fpath: Path, metadata_dir: Path) -> bool:
+        if fpath.suffix.lower() not in EXTRACTABLE_SUFFIXES or self._extraction_current(metadata_dir):
+            return False
+        stage = self.db.get_content_stage(metadata_dir.name, "extract")
+        current = stage is None or stage[0] == self.extraction_options.version()
+        # Page ranges of an interrupted extraction are kept while the extraction settings stay the same
+        for text_data in [*metadata_dir.glob("*.textdata.json"), *([] if current else metadata_dir.glob("*.segment.json"))]:
+            text_data.unlink()
+        return True
+
+    def _finish_ocr_job(
+        self,
+        job: list[ExtractionEntry],
+        results: dict[str, list[str]],
+        duration: float = 0.0,
+        error: str = "",
+    ):
+        extracted = [entry.fpath for entry in job if entry.fpath.as_posix() in results]
+        for fpath, metadata_dir, pages, status, actions in job:
+            file_actions = results.get(fpath.as_posix())
+            share = duration / len(extracted) if file_actions is not None else 0.0
+            if pages is not None:
+                self._finish_segment(fpath, metadata_dir, file_actions, share, error)
+                continue
+            if file_actions is not None:
+                self._count("ocred")
+            errors = [action.removeprefix("error=") for action in file_actions or [] if action.startswith("error=")]
+            if errors or (error and file_actions is None):
+                self._record_stage(fpath, "extract", metadata_dir.name, error="; ".join(errors) or error)
+            else:
+                self._extraction_done(fpath, metadata_dir, share)
+            self._count("processed")
+            actions.extend(file_actions or [])
+            self._index_file(fpath, metadata_dir)
+            actiontext = "\t".join(actions)
+            sys.stderr.write(f"{status} \t {actiontext}\n")
+
+    def _extraction_done(self, fpath: Path, metadata_dir: Path, duration: float):
+        self._record_stage(fpath, "extract", metadata_dir.name, duration)
+        if fpath in self._fallbacks:
+            self.db.set_quarantine_state(fpath, "recovered")
+
+    # Extractions tried, in order, for files that were quarantined
+    QUARANTINE_FALLBACKS = ("low-dpi", "text")
+
+    def _fallback_options(self, fpath: Path, attempts: int) -> tuple[str, ExtractionOptions] | None:
+        # Images have no text layer to fall back to
+        fallbacks = self.QUARANTINE_FALLBACKS if fpath.suffix.lower() == ".pdf" else self.QUARANTINE_FALLBACKS[:1]
+        if attempts > len(fallbacks):
+            return None
+        options = copy.copy(self.extraction_options)
+        if fallbacks[attempts - 1] == "low-dpi":
+            options.pdf_dpi = max(72, options.pdf_dpi // 2)
+            options.image_step = 2
+        else:
+            options.pdf_text_policy = "text"
+        return fallbacks[attempts - 1], options
+
+    def _plan_extraction(
+        self,
+        fpath: Path,
+        metadata_dir: Path,
+        status: str,
+        actions: list[str],
+        pending: PendingJobs,
+    ) -> ExtractionEntry | None:
+        # The job entry of the file, or None once it was handed over on its own
+        entry = ExtractionEntry(fpath, metadata_dir, None, status, actions)
+        quarantined = self.db.get_quarantine(fpath, metadata_dir.name)
+        if quarantined is not None:
+            fallback = self._fallback_options(fpath, quarantined[1])
+            if fallback is None:
+                # Nothing left to try until the file changes, it is indexed without its text
+                actions.append(f"quarantined={quarantined[0]}")
+                self._finish_ocr_job([entry], {}, error=f"quarantined: {quarantined[0]}")
+                return None
+            actions.append(f"fallback={fallback[0]}")
+            self._fallbacks[fpath] = fallback[1]
+        entry = self._split_document(fpath, metadata_dir, status, actions) or entry
+        if fpath in self._fallbacks:
+            # Quarantined files run alone so they cannot take other files down with them
+            self._submit_ocr_job([entry], pending, self._fallbacks[fpath])
+            return None
+        return entry
+
+    def _add_segment(
+        self,
+        job: list[ExtractionEntry],
+        pending: PendingJobs,
+        fpath: Path,
+        md5sum: str,
+        pages: tuple[int, int],
+    ) -> list[ExtractionEntry]:
+        entry = ExtractionEntry(fpath, self.work_dir / md5sum, pages, "", [])
+        if fpath in self._fallbacks:
+            self._submit_ocr_job([entry], pending, self._fallbacks[fpath])
+            return job
+        return self._append_job(job, pending, entry)
+
+    def _append_job(
+        self,
+        job: list[ExtractionEntry],
+        pending: PendingJobs,
+        entry: ExtractionEntry,
+    ) -> list[ExtractionEntry]:
+        # Files are handed over in groups so their pages can share inference batches. Entries of one path go to
+        # different jobs: page ranges so they can run on several workers, and the contents of a file modified
+        # during the analysis because results are keyed by path.
+        if any(other.fpath == entry.fpath for other in job):
+            self._submit_ocr_job(job, pending)
+            job = []
+        job.append(entry)
+        if len(job) >= self.governor.job_size(self.extraction_options.page_batch):
+            self._submit_ocr_job(job, pending)
+            return []
+        return job
+
+    def _split_document(self, fpath: Path, metadata_dir: Path, status: str, actions: list[str]) -> ExtractionEntry | None:
+        # PDFs are extracted in page ranges of segment_pages that are queued like files, so a single large document
+        # cannot hold a worker while everything else waits. Only the OCR workers open the document: the first range
+        # reports the page count and the remaining ranges are queued when it completes.
+        if self.config.segment_pages <= 0 or fpath.suffix.lower() != ".pdf":
+            return None
+        first = (0, self.config.segment_pages)
+        if (metadata_dir / segment_name(first)).exists():
+            # Left by an interrupted extraction, the worker only counts the pages
+            first = (0, 0)
+        self._segments[fpath] = {"ranges": None, "remaining": 1, "duration": 0.0, "errors": [], "status": status, "actions": actions}
+        return ExtractionEntry(fpath, metadata_dir, first, "", [])
+
+    def _queue_segments(self, fpath: Path, metadata_dir: Path, segment: dict, file_actions: list[str]):
+        page_count = next(int(action.removeprefix("pages=")) for action in file_actions if action.startswith("pages="))
+        segment["ranges"] = [(start, start + self.config.segment_pages) for start in range(0, page_count, self.config.segment_pages)]
+        remaining = [pages for pages in segment["ranges"] if not (metadata_dir / segment_name(pages)).exists()]
+        if len(segment["ranges"]) > 1:
+            segment["actions"].append(f"segments={len(segment['ranges'])}")
+        segment["remaining"] += len(remaining)
+        if remaining and self.analysis_queue is not None:
+            self.analysis_queue.push_segments(fpath, metadata_dir.name, remaining, page_count)
+
+    def _finish_segment(self, fpath: Path, metadata_dir: Path, file_actions: list[str] | None, duration: float, error: str):
+        segment = self._segments.get(fpath)
+        if segment is None:
+            return
+        segment["remaining"] -= 1
+        segment["duration"] += duration
+        segment["errors"] += [action.removeprefix("error=") for action in file_actions or [] if action.startswith("error=")]
+        if error and file_actions is None:
+            segment["errors"].append(error)
+        if segment["ranges"] is None and not segment["errors"]:
+            self._queue_segments(fpath, metadata_dir, segment, file_actions or [])
+        if segment["remaining"] > 0:
+            return
+        del self._segments[fpath]
+        actions = segment["actions"]
+        errors = segment["errors"]
+        if not errors:
+            try:
+                actions.append(merge_segments(metadata_dir, segment["ranges"]))
+            except (OSError, ValueError) as exc:
+                errors.append(str(exc))
+        if errors:
+            # Page ranges that were extracted are kept, the retry only extracts the missing ones
+            self._record_stage(fpath, "extract", metadata_dir.name, error="; ".join(errors))
+            actions.extend(f"error={error}" for error in errors)
+        else:
+            self._count("ocred")
+            self._extraction_done(fpath, metadata_dir, segment["duration"])
+        self._count("processed")
+        self._index_file(fpath, metadata_dir)
+        actiontext = "\t".join(actions)
+        sys.stderr.write(f"{segment['status']} \t {actiontext}\n")
+
+    def _collect_ocr_results(
+        self,
+        pending: PendingJobs,
+    ):
+        done, _ = concurrent.futures.wait(pending.keys(), return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            if future not in pending:
+                # Already collected while isolating the files of another job
+                continue
+            job, submitted, options = pending.pop(future)
+            results: dict[str, list[str]] = {}
+            error = ""
+            try:
+                results = future.result()
+            except QuarantineException as exc:
+                # Any of the files may have taken the worker down
+                if self._isolate_files(job, pending, options, str(exc)):
+                    continue
+                entry = job[0]
+                sys.stderr.write(f"Quarantined {entry.fpath.as_posix()}: {str(exc)}\n")
+                # A document moves on to the next fallback once, however many of its page ranges failed
+                if entry.pages is None or not self._segments.get(entry.fpath, {}).get("errors"):
+                    self.db.quarantine_file(entry.fpath, entry.metadata_dir.name, str(exc))
+                error = f"quarantined: {str(exc)}"
+            except Exception as exc:  # Worker exceptions arrive untyped
+                if self._isolate_files(job, pending, options, str(exc)):
+                    continue
+                sys.stderr.write(f"Cannot OCR {job[0].fpath.as_posix()}: {str(exc)}\n")
+                error = str(exc)
+            self._finish_ocr_job(job, results, time.monotonic() - submitted, error)
+
+    def _isolate_files(
+        self,
+        job: list[ExtractionEntry],
+        pending: PendingJobs,
+        options: ExtractionOptions | None,
+        error: str,
+    ) -> bool:
+        # The files of a failed job are retried on their own, together they would be batched and fail together again
+        if len(job) == 1:
+            return False
+        sys.stderr.write(f"OCR failed on {len(job)} files, isolating them: {error}\n")
+        for entry in job:
+            self._submit_ocr_job([entry], pending, options)
+        return True
+
+    def _submit_ocr_job(
+        self,
+        job: list[ExtractionEntry],
+        pending: PendingJobs,
+        options: ExtractionOptions | None = None,
+    ):
+        paths = [(entry.fpath.as_posix(), entry.metadata_dir.as_posix(), entry.pages) for entry in job]
+        self.governor.wait(lambda: self.analysis is not None and self.analysis.cancelled)
+        if self.config.ocr_workers == 0:
+            self.get_model()
+            self._apply_torch_threads()
+            start = time.monotonic()
+            try:
+                results = extract_texts(self.get_model(), paths, options or self.extraction_options)
+            except OCRException as exc:
+                if self._isolate_files(job, pending, options, str(exc)):
+                    return
+                sys.stderr.write(f"Cannot OCR {job[0].fpath.as_posix()}: {str(exc)}\n")
+                self._finish_ocr_job(job, {}, time.monotonic() - start, str(exc))
+                return
+            self._finish_ocr_job(job, results, time.monotonic() - start)
+            return
+        # Keep a bounded backlog in the pool so results are indexed as they arrive. Each job runs with the torch
+        # threads of the current CPU budget, which also decides how many workers may be busy at once.
+        threads = self._worker_threads()
+        busy = min(self.config.ocr_workers, max(1, self.governor.cpu_budget() // threads))
+        while len(pending) >= (2 * busy if self.governor.mode == "throughput" else busy):
+            self._collect_ocr_results(pending)
+        pending[self._get_ocr_pool().submit(paths, options, threads)] = (job, time.monotonic(), options)
+
+    RECENT_AGE = 86400
+
+    def _priority(self, fpath: Path, md5sum: str, lastmodified: int, size: int) -> tuple:
+        # Lowest first: paths requested through /scan, recently modified files, contents that only need
+        # indexing before PDFs (usually a text layer) before images (always OCR), then smaller files
+        now = time.time()
+        boosted = any(fpath.is_relative_to(path) for path, expiry in list(self._boosts.items()) if expiry > now)
+        age = now - lastmodified
+        recency = 0 if age < self.RECENT_AGE else 1 if age < 30 * self.RECENT_AGE else 2
+        if fpath.suffix.lower() not in EXTRACTABLE_SUFFIXES or (md5sum and not needs_text_extraction(self.work_dir / md5sum)):
+            cost = 0
+        else:
+            cost = 1 if fpath.suffix.lower() == ".pdf" else 2
+        return (not boosted, recency, cost, size)
+
+    def _enqueue_pending(self, backlog: AnalysisQueue, analysis: Job) -> int:
+        added = 0
+        for fpath, md5sum, lastmodified, size in self.db.get_pending_work(self._stage_versions()):
+            if backlog.push(self._priority(fpath, md5sum, lastmodified, size), fpath, md5sum, lastmodified, size):
+                added += 1
+        analysis.count("discovered", added)
+        analysis.add_total(added)
+        return added
+
+    def _prepare_analysis(self, fpath: Path, md5sum: str | None, actions: list[str], status: str, analysis: Job) -> Path | None:
+        sys.stderr.write(f"{status} Analyzing {fpath.as_posix()}\n")
+        if fpath in self._segments and self.analysis_queue is not None:
+            # Modified while the page ranges of its previous contents are extracted, queued again once they are done
+            sys.stderr.write(f"{status} \t busy\n")
+            self.analysis_queue.release(fpath)
+            analysis.count("processed")
+            return None
+        if md5sum is None:
+            analysis.count("processed")
+            return None
+        analysis.count("hashed")
+        try:
+            metadata_dir, prepare_actions = self._prepare_file(fpath, md5sum)
+        except OSError as exc:
+            sys.stderr.write(f"Cannot Analyze {str(fpath)}: {str(exc)}")
+            analysis.count("processed")
+            return None
+        actions.extend(prepare_actions)
+        return metadata_dir
+
+    def _analyze_backlog(self, backlog: AnalysisQueue, analysis: Job):
+        pending: PendingJobs = {}
+        job: list[ExtractionEntry] = []
+        # dedup mode: contents seen in this pass (or already indexed) only get their path lists updated
+        seen_contents: set[str] = set()
+        regroup: set[str] = set()
+        # Copies of a content that is still being extracted are indexed once its textdata exists
+        extracting: set[str] = set()
+        waiting: list[ExtractionEntry] = []
+        count = 0
+        # Page ranges are queued when the first range of their document completes, possibly after the hash stage
+        # has drained the backlog
+        while (backlog or pending or job) and not analysis.cancelled:
+            if job and not backlog:
+                self._submit_ocr_job(job, pending)
+                job = []
+            if not backlog:
+                self._collect_ocr_results(pending)
+                continue
+            for fpath, md5sum, actions, pages in self._hash_files(backlog.drain()):
+                if analysis.cancelled:
+                    # Work already handed to the OCR workers is still finished and indexed
+                    break
+                if pages is not None:
+                    job = self._add_segment(job, pending, fpath, md5sum, pages)
+                    continue
                 count += 1
-                try:
-                    self.analyze_file(Path(fpath), md5sum, ("[" + str(count) + "/" + str(total) + "]"))
-                except OSError as exc:
-                    sys.stderr.write(f"Cannot Analyze {str(fpath)}: {str(exc)}")
+                status = "[" + str(count) + "/" + str(analysis.total) + "]"
+                metadata_dir = self._prepare_analysis(fpath, md5sum, actions, status, analysis)
+                if metadata_dir is None:
+                    continue
+                # An indexed content whose extraction is outdated or failed goes through extraction with its first copy
+                indexed = self.db.is_content_indexed(md5sum) and self._extraction_current(metadata_dir)
+                if self.config.dedup and (md5sum in seen_contents or indexed):
+                    analysis.count("processed")
+                    regroup.add(md5sum)
+                    sys.stderr.write(f"{status} \t {chr(9).join(actions + ['duplicate'])}\n")
+                    continue
+                seen_contents.add(md5sum)
+                if md5sum in extracting:
+                    waiting.append(ExtractionEntry(fpath, metadata_dir, None, status, actions))
+                    continue
+                if not self._needs_extraction(fpath, metadata_dir):
+                    self._finish_ocr_job([ExtractionEntry(fpath, metadata_dir, None, status, actions)], {})
+                    continue
+                extracting.add(md5sum)
+                entry = self._plan_extraction(fpath, metadata_dir, status, actions, pending)
+                if entry is None:
+                    continue
+                job = self._append_job(job, pending, entry)
+        self._finish_backlog(job, pending, waiting, regroup, analysis)
 
-        with self.mutex:
-            del self.tasks["analyze"]
-
-
-parser = argparse.ArgumentParser(description="Scan Directories for duplicates")
-parser.add_argument("--work-dir", type=Path, default=None)
-parser.add_argument("--port", type=int, default=5000)
-parser.add_argument("--warm-up-doctr-cache", type=Path, default=None, help="Warm up the doctr cache")
-parser.add_argument("--analyze-file", type=Path, default=None, help="Analyze File")
-parser.add_argument("dirs", type=Path, nargs="*")
-args = parser.parse_args()
-if args.analyze_file is not None:
-    svc = PaperTrailService(work_dir=args.warm_up_doctr_cache, port=args.port)
-    svc.analyze_file(args.analyze_file, "", "")
-    sys.exit(0)
-
-if args.warm_up_doctr_cache is not None:
-    svc = PaperTrailService(work_dir=args.warm_up_doctr_cache, port=args.port)
-    svc.warm_up_doctr_cache()
-    sys.exit(0)
-
-svc = PaperTrailService(work_dir=args.work_dir, port=args.port)
-for sdir in args.dirs:
-    svc.scan(Path(sdir))
-svc.start()
-svc.wait_for_stop()
+    def _finish_backlog(
+        self,
+        job: list[ExtractionEntry],
+        pending: PendingJobs,
+        waiting: list[ExtractionEntry],
+        regroup: set[str],
+        analysis: Job,
+    ):
+        if job and not analysis.cancelled:
+            self._submit_ocr_job(job, pending)
+        while pending:
+            self._collect_ocr_results(pending)
+        self._finish_ocr_job(waiting, {})
+        for md5sum in regroup:
+            self._update_duplicate_group(md5sum)
+
+    def analyze_all(self, analysis: Job | None = None) -> dict[str, object]:
+        analysis = analysis or Job("analyze")
+        lower_thread_priority(self.governor.nice)
+        # Each state of a file is analyzed once per run, files that become pending meanwhile join the backlog by priority
+        backlog = self.analysis_queue = AnalysisQueue()
+        self._segments = {}
+        self._fallbacks = {}
+        while not analysis.cancelled:
+            with self.mutex:
+                self._enqueue_pending(backlog, analysis)
+                if not backlog:
+                    # start_analyze_all starts a new run for anything that becomes pending from here on
+                    self.analysis_queue = None
+                    if self.analysis is analysis:
+                        self.analysis = None
+                    break
+            self._analyze_backlog(backlog, analysis)
+            if self.indexer:
+                self.indexer.flush()
+        return {"analyzed": analysis.total}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scan Directories for duplicates")
+    parser.add_argument("--work-dir", type=Path, default=None)
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--warm-up-doctr-cache", type=Path, default=None, help="Warm up the doctr cache")
+    parser.add_argument("--analyze-file", type=Path, default=None, help="Analyze File")
+    parser.add_argument("--reset-index", action="store_true", default=False, help="Drop and rebuild the typesense index on startup")
+    parser.add_argument("--index-batch-size", type=int, default=100, help="Maximum documents per typesense bulk import")
+    parser.add_argument("--index-max-latency", type=float, default=1.0, help="Maximum seconds a document waits before being imported")
+    parser.add_argument(
+        "--ocr-workers", type=int, default=1, help="Supervised OCR worker processes (0 runs OCR unsupervised on the analysis thread)"
+    )
+    parser.add_argument("--ocr-timeout", type=float, default=300, help="Seconds per file before an OCR worker is killed")
+    parser.add_argument("--ocr-max-rss-mb", type=int, default=4096, help="Resident memory an OCR worker may use (0 for no limit)")
+    parser.add_argument(
+        "--ocr-threads",
+        type=int,
+        default=0,
+        help="Torch intra-op threads per OCR worker (0 shares the governor CPU budget among the workers)",
+    )
+    parser.add_argument("--ocr-page-batch", type=int, default=8, help="Pages per OCR inference batch, shared across files")
+    parser.add_argument(
+        "--ocr-det-arch", default=None, help="doctr detection architecture, e.g. db_mobilenet_v3_large (the doctr default if unset)"
+    )
+    parser.add_argument(
+        "--ocr-reco-arch", default=None, help="doctr recognition architecture, e.g. crnn_mobilenet_v3_small (the doctr default if unset)"
+    )
+    parser.add_argument("--ocr-quantize", action="store_true", default=False, help="int8 dynamic quantization of the recognition model")
+    parser.add_argument(
+        "--ocr-channels-last",
+        action="store_true",
+        default=False,
+        help="Run inference under torch.inference_mode with channels-last weights",
+    )
+    parser.add_argument("--ocr-compile", action="store_true", default=False, help="torch.compile the models, cached in the doctr cache")
+    parser.add_argument("--pdf-dpi", type=int, default=144, help="Resolution PDF pages are rendered at for OCR")
+    parser.add_argument(
+        "--pdf-text-policy",
+        choices=["text-first", "ocr", "text"],
+        default="text-first",
+        help="Use the PDF text layer and OCR only pages without enough text, OCR every page, or never OCR",
+    )
+    parser.add_argument("--max-page-pixels", type=int, default=0, help="Downsample page images to this many pixels (0 keeps the full size)")
+    parser.add_argument("--deskew", action="store_true", default=False, help="Turn sideways pages and straighten skewed ones before OCR")
+    parser.add_argument("--skip-blank-pages", action="store_true", default=False, help="Do not run OCR on pages without ink")
+    parser.add_argument("--min-text-chars", type=int, default=32, help="Characters a PDF text layer needs for a page to skip OCR")
+    parser.add_argument("--pdf-text-geometry", action="store_true", default=False, help="Record word boxes for PDF text layers")
+    parser.add_argument("--scan-workers", type=int, default=8, help="Threads used to walk directories in parallel")
+    parser.add_argument("--watch", action="store_true", default=False, help="Watch the directories for changes with inotify")
+    parser.add_argument("--reconcile-interval", type=float, default=3600, help="Seconds between rescans that catch missed watch events")
+    parser.add_argument("--hash-workers", type=int, default=4, help="Threads used to hash file contents ahead of OCR")
+    parser.add_argument("--dedup", action="store_true", default=False, help="Index identical files once, listing all of their paths")
+    parser.add_argument(
+        "--index-granularity", choices=INDEX_GRANULARITIES, default="document", help="Index whole files, single pages or text chunks"
+    )
+    parser.add_argument("--chunk-kb", type=int, default=64, help="Chunk size in kilobytes for --index-granularity chunk")
+    parser.add_argument(
+        "--search-client", choices=("async", "executor"), default="async", help="Pooled aiohttp session or the typesense client in a thread"
+    )
+    parser.add_argument("--search-concurrency", type=int, default=32, help="Maximum concurrent searches against typesense")
+    parser.add_argument("--search-cache-size", type=int, default=256, help="Cached search responses, 0 disables the cache")
+    parser.add_argument("--search-cache-ttl", type=float, default=30.0, help="Seconds a cached search response stays valid")
+    parser.add_argument(
+        "--governor-mode", choices=ResourceGovernor.MODES, default="latency", help="Favor search latency or analysis throughput"
+    )
+    parser.add_argument("--analysis-cpus", type=int, default=0, help="CPUs available to analysis (0 detects affinity and cgroup limits)")
+    parser.add_argument("--analysis-nice", type=int, default=10, help="Niceness of the analysis threads and OCR workers")
+    parser.add_argument(
+        "--segment-pages", type=int, default=50, help="PDFs with more pages are extracted in ranges of this size (0 disables)"
+    )
+    parser.add_argument("dirs", type=Path, nargs="*")
+    args = parser.parse_args()
+    extraction_options = ExtractionOptions(
+        page_batch=args.ocr_page_batch,
+        pdf_dpi=args.pdf_dpi,
+        pdf_text_policy=args.pdf_text_policy,
+        min_text_chars=args.min_text_chars,
+        pdf_text_geometry=args.pdf_text_geometry,
+        det_arch=args.ocr_det_arch,
+        reco_arch=args.ocr_reco_arch,
+        quantize=args.ocr_quantize,
+        channels_last=args.ocr_channels_last,
+        compile_model=args.ocr_compile,
+        max_page_pixels=args.max_page_pixels,
+        deskew=args.deskew,
+        skip_blank=args.skip_blank_pages,
+    )
+    if args.analyze_file is not None:
+        svc = PaperTrailService(args.warm_up_doctr_cache, ServiceConfig(port=args.port, extraction_options=extraction_options))
+        svc.analyze_file(args.analyze_file, "", "")
+        sys.exit(0)
+
+    if args.warm_up_doctr_cache is not None:
+        svc = PaperTrailService(args.warm_up_doctr_cache, ServiceConfig(port=args.port, extraction_options=extraction_options))
+        svc.warm_up_doctr_cache()
+        sys.exit(0)
+
+    config = ServiceConfig(
+        port=args.port,
+        reset_index=args.reset_index,
+        index_batch_size=args.index_batch_size,
+        index_max_latency=args.index_max_latency,
+        ocr_workers=args.ocr_workers,
+        ocr_threads=args.ocr_threads,
+        extraction_options=extraction_options,
+        scan_workers=args.scan_workers,
+        watch_dirs=args.dirs if args.watch else [],
+        reconcile_interval=args.reconcile_interval,
+        hash_workers=args.hash_workers,
+        dedup=args.dedup,
+        index_granularity=args.index_granularity,
+        chunk_kb=args.chunk_kb,
+        search_client=args.search_client,
+        search_concurrency=args.search_concurrency,
+        search_cache_size=args.search_cache_size,
+        search_cache_ttl=args.search_cache_ttl,
+        governor=ResourceGovernor(args.governor_mode, args.analysis_cpus, args.analysis_nice),
+        segment_pages=args.segment_pages,
+        ocr_timeout=args.ocr_timeout,
+        ocr_max_rss_mb=args.ocr_max_rss_mb,
+    )
+    svc = PaperTrailService(args.work_dir, config)
+    svc.start(args.dirs)
+    svc.wait_for_stop()
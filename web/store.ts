@@ -1,37 +1,46 @@
 import { writable, type Writable } from "svelte/store"
 
+export interface SearchResultPageType {
+    page: number
+    url: string
+    snippet: string
+}
+
 export interface SearchResultItemType {
+    id: string
     snippet: string
-    contents: string
     url: string
     filename: string
+    urls?: string[]
+    pages?: SearchResultPageType[]
 }
 
-const EmptySearchResultItemType: SearchResultItemType = {
-    snippet: "",
-    contents: "",
-    url: "",
-    filename: ""
+export interface DocumentTextType {
+    id: string
+    pages: number
+    page?: number
+    text: string
+    // Present when requested: character ranges of the page text with their [x0, y0, x1, y1] box
+    words?: { start: number, end: number, box: number[] | null }[]
 }
 
 export const vm_selectedIds: Writable<{ [item_id: string]: boolean }> = writable({})
 
-export async function SearchTypesense(searchTerm: string): Promise<SearchResultItemType[]> {
+export async function SearchTypesense(searchTerm: string, page: number = 1, signal?: AbortSignal): Promise<SearchResultItemType[]> {
     let searchParameters = {
-        'q': searchTerm
+        'q': searchTerm,
+        'page': String(page)
     }
-    const response = await fetch('/search?' + new URLSearchParams(searchParameters))
+    const response = await fetch('/search?' + new URLSearchParams(searchParameters), { signal })
+    // The server already reshapes hits into the compact result items, contents are loaded lazily
     const searchResults = await response.json();
-    let results: SearchResultItemType[] = []
-    if (searchResults.hits && searchResults.hits.length > 0) {
-        let hits = searchResults.hits
-        hits.forEach((hit) => {
-            let searchResultItem: SearchResultItemType = { ...EmptySearchResultItemType }
-            if (hit.highlights && hit.highlights.length > 0)
-                searchResultItem.snippet = hit.highlights[0].snippet
-            Object.assign(searchResultItem, hit.document);
-            results.push(searchResultItem)
-        });
-    }
-    return results
+    return searchResults.hits ?? []
+};
+
+export async function FetchDocumentText(id: string, page?: number, words: boolean = false): Promise<DocumentTextType> {
+    const params: { [key: string]: string } = page === undefined ? {} : { 'page': String(page) }
+    if (words && page !== undefined) params['words'] = '1'
+    const query = Object.keys(params).length === 0 ? '' : '?' + new URLSearchParams(params)
+    const response = await fetch(`/document/${encodeURIComponent(id)}/text${query}`)
+    return await response.json()
 };